@@ -0,0 +1,607 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""A local stand-in for the Synnefo APIs used by the role modules
+
+Emulates the Astakos (identity, account, quotas), Cyclades compute (with
+flavors and images), Cyclades network and Cyclades volume endpoints in
+memory, with a configurable latency per request. Pithos is not emulated.
+Counts the API calls per route, the bytes transferred and the connections
+opened.
+
+Run it standalone with: python fake_synnefo.py --servers 1000 --latency 0.05
+"""
+import argparse
+import base64
+import itertools
+import json
+import re
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+TOKEN, USER, PROJECT = 'fake-token', 'fake-user', 'fake-project'
+PUBLIC_NET = 'public'
+IDENTITY, ACCOUNT = '/identity/v2.0', '/account/v1.0'
+COMPUTE, NETWORK = '/compute/v2.0', '/network/v2.0'
+VOLUME = '/volume/v2.0'
+FLAVORS = [dict(
+    id=id_, name='C{}R{}D{}drbd'.format(cpus, ram, disk), vcpus=cpus,
+    ram=ram, disk=disk, **{'SNF:disk_template': 'drbd'}) for (
+        id_, cpus, ram, disk) in (
+            (1, 1, 1024, 20), (2, 2, 2048, 20), (3, 4, 4096, 40),
+            (4, 8, 8192, 80))]
+IMAGES = [
+    dict(id='img', name='Debian Base', status='ACTIVE',
+         updated='2018-01-01T00:00:00+00:00',
+         metadata=dict(os='debian', osfamily='linux')),
+    dict(id='img-ubuntu', name='Ubuntu Server', status='ACTIVE',
+         updated='2018-02-01T00:00:00+00:00',
+         metadata=dict(os='ubuntu', osfamily='linux')),
+]
+# Astakos resource: project limit, for the quotas of the fake project
+QUOTA_LIMITS = {
+    'cyclades.vm': 100000, 'cyclades.total_cpu': 400000,
+    'cyclades.cpu': 400000, 'cyclades.total_ram': 400000 * 2 ** 30,
+    'cyclades.ram': 400000 * 2 ** 30, 'cyclades.disk': 10000000 * 2 ** 30,
+}
+
+
+class NotFound(Exception):
+    pass
+
+
+class Cloud(object):
+    """The in-memory state of a Synnefo project
+       Servers and ports are in BUILD for "build_time" seconds after creation
+    """
+
+    def __init__(self, build_time=0):
+        self.build_time = build_time
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.servers, self.networks, self.ports = dict(), dict(), dict()
+        self.floatingips, self.keypairs = dict(), dict()
+        self.volumes = dict()
+        # Deleted servers, listed as such by changes-since
+        self.deleted = dict()
+        self.networks[PUBLIC_NET] = dict(
+            id=PUBLIC_NET, name='Public IPv4 Network', type='IP_LESS_ROUTED',
+            status='ACTIVE', subnets=[], public=True, tenant_id=PROJECT)
+
+    def _id(self):
+        return next(self.ids)
+
+    def _ip(self, id_, prefix='10.0'):
+        return '{}.{}.{}'.format(prefix, id_ // 250, id_ % 250 + 1)
+
+    def seed(self, servers=0, networks=0, floatingips=0, keypairs=0):
+        """Create resources in bulk, e.g., to benchmark a large project
+           Every other server is attached to a floating IP, every server to
+           one of the private networks (if any)
+        """
+        with self.lock:
+            net_ids = [self.create_network(dict(
+                name='seed-net-{}'.format(i)))['id'] for i in range(networks)]
+            for i in range(servers):
+                vm = self.create_server(dict(
+                    name='seed-vm-{}'.format(i), flavorRef=1, imageRef='img'))
+                self.servers['{}'.format(vm['id'])]['status'] = 'ACTIVE'
+                if net_ids:
+                    self.create_port(dict(
+                        network_id=net_ids[i % len(net_ids)],
+                        device_id=vm['id']))
+            vm_ids = sorted(self.servers, key=int)
+            for i in range(floatingips):
+                ip = self.create_floatingip(dict())
+                if i % 2 == 0 and i // 2 < len(vm_ids):
+                    self.create_port(dict(
+                        network_id=PUBLIC_NET, device_id=vm_ids[i // 2],
+                        fixed_ips=[dict(
+                            ip_address=ip['floating_ip_address'])]))
+            for i in range(keypairs):
+                blob = base64.b64encode('seed-key-{}'.format(i).encode())
+                self.create_keypair(dict(
+                    name='seed-key-{}'.format(i),
+                    public_key='ssh-rsa {} seed'.format(blob.decode())))
+            for port in self.ports.values():
+                port['status'] = 'ACTIVE'
+
+    def _ready(self, record):
+        if record.get('status') == 'BUILD' and (
+                time.time() - record['_created'] >= self.build_time):
+            record['status'] = 'ACTIVE'
+        return {k: v for k, v in record.items() if not k.startswith('_')}
+
+    def _get(self, collection, id_):
+        try:
+            return collection['{}'.format(id_)]
+        except KeyError:
+            raise NotFound(id_)
+
+    def ports_by_vm(self):
+        ports = dict()
+        for port in self.ports.values():
+            ports.setdefault(port['device_id'], []).append(port)
+        return ports
+
+    # servers
+    def server(self, id_, ports_by_vm=None):
+        vm = self._ready(self._get(self.servers, id_))
+        ports = (ports_by_vm or self.ports_by_vm()).get('{}'.format(id_), [])
+        vm['attachments'] = [dict(
+            id=p['id'], network_id=p['network_id'],
+            ipv4=(p['fixed_ips'] or [dict()])[0].get('ip_address'),
+            **{'OS-EXT-IPS:type': 'floating' if (
+                p['network_id'] == PUBLIC_NET) else 'fixed'}) for p in ports]
+        vm['addresses'] = dict()
+        for a in vm['attachments']:
+            vm['addresses'].setdefault(a['network_id'], []).append(dict(
+                addr=a['ipv4'], version=4))
+        return vm
+
+    def list_servers(self, detail=False, changes_since=None):
+        ports = self.ports_by_vm()
+        vms = [self.server(id_, ports) for id_ in sorted(
+            self.servers, key=int)]
+        if changes_since:
+            vms = [vm for vm in vms + list(self.deleted.values()) if (
+                vm['updated'] >= changes_since)]
+        if detail:
+            return vms
+        return [dict(id=vm['id'], name=vm['name']) for vm in vms]
+
+    def create_server(self, req):
+        id_ = self._id()
+        now = time.time()
+        self.servers['{}'.format(id_)] = dict(
+            id=id_, name=req['name'], status='BUILD', _created=now,
+            flavor=dict(id=req['flavorRef']), image=dict(id=req['imageRef']),
+            key_name=req.get('key_name'), tenant_id=req.get(
+                'project', PROJECT), metadata=req.get('metadata', dict()),
+            updated=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now)))
+        for net in req.get('networks') or []:
+            if net.get('port'):
+                self._get(self.ports, net['port'])['device_id'] = id_
+            else:
+                self.create_port(dict(
+                    network_id=net['uuid'], device_id=id_, fixed_ips=[
+                        dict(ip_address=net['fixed_ip'])] if (
+                            net.get('fixed_ip')) else None))
+        return dict(
+            self._ready(self.servers['{}'.format(id_)]),
+            adminPass='fake-password')
+
+    def update_server(self, id_, **kw):
+        vm = self._get(self.servers, id_)
+        vm.update(kw, updated=time.strftime(
+            '%Y-%m-%dT%H:%M:%S', time.gmtime()))
+
+    def delete_server(self, id_):
+        self._get(self.servers, id_)
+        vm = self.servers.pop('{}'.format(id_))
+        self.deleted['{}'.format(id_)] = dict(
+            id=vm['id'], name=vm['name'], status='DELETED', attachments=[],
+            updated=time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()))
+        for port in list(self.ports.values()):
+            if '{}'.format(port['device_id']) == '{}'.format(id_):
+                self.delete_port(port['id'])
+
+    # networks, subnets, ports
+    def create_network(self, req):
+        id_ = '{}'.format(self._id())
+        self.networks[id_] = dict(
+            id=id_, name=req.get('name', ''), type=req.get('type'),
+            status='ACTIVE', subnets=[], public=False,
+            tenant_id=req.get('project', PROJECT))
+        return dict(self.networks[id_])
+
+    def create_subnet(self, req):
+        id_ = '{}'.format(self._id())
+        self._get(self.networks, req['network_id'])['subnets'].append(id_)
+        return dict(req, id=id_)
+
+    def create_port(self, req):
+        id_ = '{}'.format(self._id())
+        self._get(self.networks, req['network_id'])
+        self.ports[id_] = dict(
+            id=id_, network_id=req['network_id'],
+            device_id='{}'.format(req.get('device_id') or ''),
+            status='BUILD', _created=time.time(),
+            fixed_ips=req.get('fixed_ips') or [
+                dict(ip_address=self._ip(int(id_)))])
+        address = self.ports[id_]['fixed_ips'][0]['ip_address']
+        for ip in self.floatingips.values():
+            if ip['floating_ip_address'] == address:
+                ip.update(port_id=id_, instance_id=req.get('device_id'))
+        return self._ready(self.ports[id_])
+
+    def delete_port(self, id_):
+        self._get(self.ports, id_)
+        self.ports.pop('{}'.format(id_))
+        for ip in self.floatingips.values():
+            if ip['port_id'] == '{}'.format(id_):
+                ip.update(port_id=None, instance_id=None)
+
+    # floating IPs, keypairs
+    def create_floatingip(self, req):
+        id_ = '{}'.format(self._id())
+        self.floatingips[id_] = dict(
+            id=id_, floating_network_id=PUBLIC_NET, port_id=None,
+            instance_id=None, tenant_id=req.get('project', PROJECT),
+            floating_ip_address=req.get('floating_ip_address') or (
+                self._ip(int(id_), '83.212')))
+        return dict(self.floatingips[id_])
+
+    def create_keypair(self, req):
+        key = dict(
+            name=req.get('name') or 'key-{}'.format(self._id()),
+            public_key=req.get('public_key') or 'ssh-rsa ZmFrZQ== fake',
+            fingerprint='00:00')
+        self.keypairs[key['name']] = key
+        if not req.get('public_key'):
+            return dict(key, private_key='fake-private-key')
+        return dict(key)
+
+    # volumes
+    def create_volume(self, req):
+        id_ = '{}'.format(self._id())
+        self._get(self.servers, req['server_id'])
+        self.volumes[id_] = dict(
+            id=id_, display_name=req.get('display_name'),
+            size=req.get('size'), volume_type=req.get('volume_type'),
+            status='in_use', attachments=[dict(
+                server_id='{}'.format(req['server_id']))])
+        return dict(self.volumes[id_])
+
+    # Astakos
+    def quotas(self):
+        """returns: the Astakos quotas of the project, with its usage"""
+        usage = dict.fromkeys(QUOTA_LIMITS, 0)
+        flavors = {'{}'.format(f['id']): f for f in FLAVORS}
+        for vm in self.servers.values():
+            flavor = flavors.get('{}'.format(vm['flavor']['id']), FLAVORS[0])
+            usage['cyclades.vm'] += 1
+            for resource, field, units in (
+                    ('cyclades.total_cpu', 'vcpus', 1),
+                    ('cyclades.cpu', 'vcpus', 1),
+                    ('cyclades.total_ram', 'ram', 2 ** 20),
+                    ('cyclades.ram', 'ram', 2 ** 20),
+                    ('cyclades.disk', 'disk', 2 ** 30)):
+                usage[resource] += flavor[field] * units
+        return {PROJECT: {resource: dict(
+            limit=limit, usage=usage[resource], pending=0,
+            project_limit=limit, project_usage=usage[resource],
+            project_pending=0) for resource, limit in QUOTA_LIMITS.items()}}
+
+    def catalog(self, base):
+        def service(type_, name, path, **extra):
+            return dict(type=type_, name=name, endpoints=[dict(
+                versionId=path.split('/')[-1], publicURL=base + path,
+                **extra)])
+        return dict(access=dict(
+            token=dict(id=TOKEN, expires='2099-01-01T00:00:00.000000+00:00',
+                       tenant=dict(id=USER)),
+            user=dict(id=USER, name='Fake User'),
+            serviceCatalog=[
+                service('identity', 'astakos_identity', IDENTITY),
+                service('account', 'astakos_account', ACCOUNT,
+                        **{'SNF:uiURL': base + '/ui'}),
+                service('compute', 'cyclades_compute', COMPUTE),
+                service('network', 'cyclades_network', NETWORK),
+                service('volume', 'cyclades_volume', VOLUME),
+            ]))
+
+
+class Route(object):
+    def __init__(self, method, pattern, name):
+        self.method, self.name = method, name
+        self.regex = re.compile('^' + pattern + '/?$')
+
+
+def route(method, pattern):
+    def decorator(func):
+        func.route = Route(method, pattern, func.__name__)
+        return func
+    return decorator
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the Synnefo API from server.cloud, keep connections alive"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        self.server.count('bytes_in', len(data))
+        return json.loads(data.decode('utf-8')) if data else dict()
+
+    def _send(self, status, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count('bytes_out', len(data))
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        for func in ROUTES:
+            match = func.route.regex.match(url.path)
+            if func.route.method == method and match:
+                break
+        else:
+            return self._send(404, dict(itemNotFound=dict(
+                code=404, message='No route to {} {}'.format(
+                    method, url.path))))
+        self.server.count_call(func.route.name)
+        body = self._body()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.headers.get('X-Auth-Token') != TOKEN and (
+                func.route.name != 'authenticate'):
+            return self._send(401, dict(unauthorized=dict(
+                code=401, message='Invalid token')))
+        try:
+            with self.server.cloud.lock:
+                status, result = func(
+                    self, self.server.cloud, body, query, *match.groups())
+        except NotFound as e:
+            status, result = 404, dict(itemNotFound=dict(
+                code=404, message='{} not found'.format(e)))
+        self._send(status, result)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    # Astakos
+    @route('POST', IDENTITY + '/tokens')
+    def authenticate(self, cloud, body, query):
+        # astakosclient sends the token in the header, kamaki in the body
+        token = body.get('auth', dict()).get('token', dict()).get('id') or (
+            self.headers.get('X-Auth-Token'))
+        if token != TOKEN:
+            return 401, dict(unauthorized=dict(code=401, message='Bad token'))
+        host = 'http://{}:{}'.format(*self.server.server_address[:2])
+        return 200, cloud.catalog(host)
+
+    @route('GET', ACCOUNT + '/projects/([^/]+)')
+    def get_project(self, cloud, body, query, id_):
+        return 200, dict(id=id_, name='Fake project', state='active')
+
+    # Compute
+    @route('GET', ACCOUNT + '/quotas')
+    def get_quotas(self, cloud, body, query):
+        return 200, cloud.quotas()
+
+    @route('GET', COMPUTE + '/servers(/detail)?')
+    def list_servers(self, cloud, body, query, detail):
+        return 200, dict(servers=cloud.list_servers(
+            bool(detail), query.get('changes-since')))
+
+    @route('GET', COMPUTE + r'/servers/(\d+)')
+    def get_server(self, cloud, body, query, id_):
+        return 200, dict(server=cloud.server(id_))
+
+    @route('POST', COMPUTE + '/servers')
+    def create_server(self, cloud, body, query):
+        return 202, dict(server=cloud.create_server(body['server']))
+
+    @route('PUT', COMPUTE + r'/servers/(\d+)')
+    def update_server(self, cloud, body, query, id_):
+        cloud.update_server(id_, name=body['server']['name'])
+        return 204, None
+
+    @route('POST', COMPUTE + r'/servers/(\d+)/action')
+    def server_action(self, cloud, body, query, id_):
+        status = dict(start='ACTIVE', shutdown='STOPPED', reboot='ACTIVE')
+        cloud.update_server(id_, status=status[list(body)[0]])
+        return 202, None
+
+    @route('DELETE', COMPUTE + r'/servers/(\d+)')
+    def delete_server(self, cloud, body, query, id_):
+        cloud.delete_server(id_)
+        return 204, None
+
+    @route('GET', COMPUTE + '/flavors(/detail)?')
+    def list_flavors(self, cloud, body, query, detail):
+        return 200, dict(flavors=FLAVORS)
+
+    @route('GET', COMPUTE + '/images(/detail)?')
+    def list_images(self, cloud, body, query, detail):
+        return 200, dict(images=IMAGES)
+
+    @route('GET', COMPUTE + '/images/(?!detail)([^/]+)')
+    def get_image(self, cloud, body, query, id_):
+        return 200, dict(image=dict(id=id_, metadata=dict(
+            os='debian', users='root')))
+
+    @route('GET', COMPUTE + '/os-keypairs')
+    def list_keypairs(self, cloud, body, query):
+        return 200, dict(keypairs=list(cloud.keypairs.values()))
+
+    @route('GET', COMPUTE + '/os-keypairs/([^/]+)')
+    def get_keypair(self, cloud, body, query, name):
+        return 200, dict(keypair=cloud._get(cloud.keypairs, name))
+
+    @route('POST', COMPUTE + '/os-keypairs')
+    def create_keypair(self, cloud, body, query):
+        return 201, dict(keypair=cloud.create_keypair(body['keypair']))
+
+    @route('DELETE', COMPUTE + '/os-keypairs/([^/]+)')
+    def delete_keypair(self, cloud, body, query, name):
+        cloud._get(cloud.keypairs, name)
+        cloud.keypairs.pop(name)
+        return 204, None
+
+    # Network
+    @route('GET', NETWORK + '/networks(/detail)?')
+    def list_networks(self, cloud, body, query, detail):
+        return 200, dict(networks=list(cloud.networks.values()))
+
+    @route('GET', NETWORK + '/networks/(?!detail)([^/]+)')
+    def get_network(self, cloud, body, query, id_):
+        return 200, dict(network=cloud._get(cloud.networks, id_))
+
+    @route('POST', NETWORK + '/networks')
+    def create_network(self, cloud, body, query):
+        return 201, dict(network=cloud.create_network(body['network']))
+
+    @route('PUT', NETWORK + '/networks/(?!detail)([^/]+)')
+    def update_network(self, cloud, body, query, id_):
+        net = cloud._get(cloud.networks, id_)
+        net.update(body['network'])
+        return 200, dict(network=net)
+
+    @route('DELETE', NETWORK + '/networks/(?!detail)([^/]+)')
+    def delete_network(self, cloud, body, query, id_):
+        cloud._get(cloud.networks, id_)
+        cloud.networks.pop(id_)
+        return 204, None
+
+    @route('POST', NETWORK + '/subnets')
+    def create_subnet(self, cloud, body, query):
+        return 201, dict(subnet=cloud.create_subnet(body['subnet']))
+
+    @route('GET', NETWORK + '/ports(/detail)?')
+    def list_ports(self, cloud, body, query, detail):
+        return 200, dict(ports=[cloud._ready(p) for p in cloud.ports.values()])
+
+    @route('GET', NETWORK + '/ports/(?!detail)([^/]+)')
+    def get_port(self, cloud, body, query, id_):
+        return 200, dict(port=cloud._ready(cloud._get(cloud.ports, id_)))
+
+    @route('POST', NETWORK + '/ports')
+    def create_port(self, cloud, body, query):
+        return 201, dict(port=cloud.create_port(body['port']))
+
+    @route('DELETE', NETWORK + '/ports/(?!detail)([^/]+)')
+    def delete_port(self, cloud, body, query, id_):
+        cloud.delete_port(id_)
+        return 204, None
+
+    @route('GET', NETWORK + '/floatingips')
+    def list_floatingips(self, cloud, body, query):
+        return 200, dict(floatingips=list(cloud.floatingips.values()))
+
+    @route('GET', NETWORK + '/floatingips/([^/]+)')
+    def get_floatingip(self, cloud, body, query, id_):
+        return 200, dict(floatingip=cloud._get(cloud.floatingips, id_))
+
+    @route('POST', NETWORK + '/floatingips')
+    def create_floatingip(self, cloud, body, query):
+        return 200, dict(floatingip=cloud.create_floatingip(
+            body['floatingip']))
+
+    @route('DELETE', NETWORK + '/floatingips/([^/]+)')
+    def delete_floatingip(self, cloud, body, query, id_):
+        cloud._get(cloud.floatingips, id_)
+        cloud.floatingips.pop(id_)
+        return 204, None
+
+    # Cyclades volumes
+    @route('GET', VOLUME + '/volumes(/detail)?')
+    def list_volumes(self, cloud, body, query, detail):
+        return 200, dict(volumes=list(cloud.volumes.values()))
+
+    @route('GET', VOLUME + '/volumes/(?!detail)([^/]+)')
+    def get_volume(self, cloud, body, query, id_):
+        return 200, dict(volume=cloud._get(cloud.volumes, id_))
+
+    @route('POST', VOLUME + '/volumes')
+    def create_volume(self, cloud, body, query):
+        return 202, dict(volume=cloud.create_volume(body['volume']))
+
+    @route('DELETE', VOLUME + '/volumes/(?!detail)([^/]+)')
+    def delete_volume(self, cloud, body, query, id_):
+        cloud._get(cloud.volumes, id_)
+        cloud.volumes.pop(id_)
+        return 202, None
+
+
+ROUTES = [f for f in vars(Handler).values() if hasattr(f, 'route')]
+
+
+class FakeSynnefo(ThreadingMixIn, HTTPServer):
+    """A threaded HTTP server with a Cloud and API call counters
+       Use port 0 to pick a free port, see "url"
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, build_time=0):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.latency, self.cloud = latency, Cloud(build_time)
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        """returns: the authentication url, to use in the cloud module"""
+        return 'http://{}:{}{}'.format(
+            self.server_address[0], self.server_address[1], IDENTITY)
+
+    def reset(self):
+        with self._lock:
+            self.calls = dict()
+            self.counters = dict(connections=0, bytes_in=0, bytes_out=0)
+
+    def count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def count_call(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counters, calls=dict(self.calls),
+                total_calls=sum(self.calls.values()),
+                list_calls=sum(n for name, n in self.calls.items() if (
+                    name.startswith('list_'))))
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--build-time', type=float, default=0)
+    for kind in ('servers', 'networks', 'floatingips', 'keypairs'):
+        parser.add_argument('--{}'.format(kind), type=int, default=0)
+    args = parser.parse_args()
+    server = FakeSynnefo(
+        port=args.port, latency=args.latency, build_time=args.build_time)
+    server.cloud.seed(
+        args.servers, args.networks, args.floatingips, args.keypairs)
+    print('url={} token={} project_id={}'.format(server.url, TOKEN, PROJECT))
+    server.serve_forever()
@@ -0,0 +1,226 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""Benchmark the role modules against a local fake Synnefo API
+
+Every scenario runs one module state on a fresh fake cloud, seeded with as
+many servers, networks, floating IPs and keypairs as the size, and records
+the wall time, the API calls (total and listings), the bytes transferred and
+the connections opened. Modules run in-process, like Ansible runs them, with
+the role module_utils. Requires ansible and kamaki.
+The pithos module is not covered, the fake API does not emulate Pithos.
+
+e.g.: python benchmarks/run.py --sizes 10 1000 --latency 0.01 --json out.json
+"""
+import argparse
+import json
+import os
+import runpy
+import sys
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import ansible.module_utils
+from ansible.module_utils import basic
+from fake_synnefo import FakeSynnefo, TOKEN, PROJECT
+
+ROLE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ansible.module_utils.__path__.append(os.path.join(ROLE, 'module_utils'))
+
+DEFAULT_SIZES = (10, 1000, 10000)
+
+
+class ModuleFailed(Exception):
+    pass
+
+
+def run_module(name, params):
+    """Run library/<name>.py with params, like Ansible does
+       returns: the module result
+    """
+    basic._ANSIBLE_ARGS = json.dumps(
+        dict(ANSIBLE_MODULE_ARGS=params)).encode('utf-8')
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        runpy.run_path(
+            os.path.join(ROLE, 'library', name + '.py'), run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+    result = json.loads(output)
+    if result.get('failed'):
+        raise ModuleFailed('{}: {}'.format(name, result.get('msg')))
+    return result
+
+
+def free_ip(cloud):
+    return [ip for ip in cloud.floatingips.values() if not ip['port_id']][0]
+
+
+def vm_id(cloud, name):
+    return [vm['id'] for vm in cloud.servers.values() if vm['name'] == name][0]
+
+
+def attached_ip(cloud):
+    return [ip for ip in cloud.floatingips.values() if ip['port_id']][0]
+
+
+def vm_ids(cloud, count):
+    return sorted(cloud.servers, key=int)[:count]
+
+
+def with_volumes(cloud, name, count):
+    """Create a volume named name on the first count VMs
+       returns: the ids of these VMs
+    """
+    ids = vm_ids(cloud, count)
+    for id_ in ids:
+        cloud.create_volume(dict(display_name=name, size=1, server_id=id_))
+    return ids
+
+
+def stopped(cloud, name):
+    cloud.update_server(vm_id(cloud, name), status='STOPPED')
+    return name
+
+
+# name: (module, state, {param: value or callable(fake cloud)})
+SCENARIOS = [
+    ('cloud', 'cloud', None, dict()),
+    ('snf_facts', 'snf_facts', None, dict()),
+    ('server.present.existing', 'server', 'present', dict(
+        name='seed-vm-0', image_id='img', flavor_id=1)),
+    ('server.present.new', 'server', 'present', dict(
+        name='bench-vm', image_id='img', flavor_id=1)),
+    ('server.present.batch', 'server', 'present', dict(
+        name='bench-vm-{index}', count=10, image_id='img', flavor_id=1)),
+    ('server.present.spec', 'server', 'present', dict(
+        name='bench-vm', image=dict(os='debian'), flavor=dict(vcpus=2))),
+    ('server.present.quota', 'server', 'present', dict(
+        name='bench-vm-{index}', count=10, image_id='img', flavor_id=1,
+        check_quota=True)),
+    ('server.stopped', 'server', 'stopped', dict(name='seed-vm-0')),
+    ('server.active', 'server', 'active', dict(
+        name=lambda c: stopped(c, 'seed-vm-0'))),
+    ('server.absent', 'server', 'absent', dict(name='seed-vm-0')),
+    ('network.present', 'network', 'present', dict(name='seed-net-0')),
+    ('network.absent', 'network', 'absent', dict(name='seed-net-0')),
+    ('network.connected', 'network', 'connected', dict(
+        name='seed-net-0', vm_id=lambda c: vm_id(c, 'seed-vm-1'))),
+    ('network.disconnected', 'network', 'disconnected', dict(
+        name='seed-net-0', vm_id=lambda c: vm_id(c, 'seed-vm-0'))),
+    ('public_ip.present', 'public_ip', 'present', dict()),
+    ('public_ip.connected', 'public_ip', 'connected', dict(
+        id=lambda c: free_ip(c)['id'],
+        vm_id=lambda c: vm_id(c, 'seed-vm-1'))),
+    ('public_ip.disconnected', 'public_ip', 'disconnected', dict(
+        id=lambda c: attached_ip(c)['id'])),
+    ('public_ip.absent', 'public_ip', 'absent', dict(
+        id=lambda c: free_ip(c)['id'])),
+    ('keypair.present', 'keypair', 'present', dict(
+        public_key='ssh-rsa c2VlZC1rZXktMA== other comment')),
+    ('keypair.absent', 'keypair', 'absent', dict(name='seed-key-0')),
+    ('volume.present', 'volume', 'present', dict(
+        name='bench-vol', size=10, servers=lambda c: vm_ids(c, 10))),
+    ('volume.absent', 'volume', 'absent', dict(
+        name='bench-vol', servers=lambda c: with_volumes(c, 'bench-vol', 10))),
+]
+
+
+def run_scenario(scenario, size, latency):
+    """returns: the measurements of a scenario on a cloud of this size"""
+    label, module, state, params = scenario
+    server = FakeSynnefo(latency=latency).start()
+    try:
+        server.cloud.seed(
+            servers=size, networks=max(2, size // 100),
+            floatingips=size, keypairs=size)
+        auth = dict(url=server.url, token=TOKEN, project_id=PROJECT)
+        if module == 'cloud':
+            args, cloud = auth, None
+        else:
+            cloud = run_module('cloud', auth)
+            args = dict(cloud=cloud)
+        args.update({k: v(server.cloud) if callable(v) else v for k, v in (
+            params.items())})
+        if state:
+            args['state'] = state
+        server.reset()
+        start = time.time()
+        error = None
+        try:
+            run_module(module, args)
+        except ModuleFailed as e:
+            error = '{}'.format(e)
+        seconds = time.time() - start
+        stats = server.stats()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return dict(
+        scenario=label, size=size, seconds=round(seconds, 3), error=error,
+        calls=stats['total_calls'], list_calls=stats['list_calls'],
+        bytes=stats['bytes_in'] + stats['bytes_out'],
+        connections=stats['connections'], by_call=stats['calls'])
+
+
+def regressions(results, baseline):
+    """Compare API calls with a baseline (results of a previous run)
+       returns: descriptions of the scenarios that need more calls now
+    """
+    before = {(r['scenario'], r['size']): r for r in baseline}
+    found = []
+    for r in results:
+        old = before.get((r['scenario'], r['size']))
+        for key in ('calls', 'list_calls'):
+            if old and r[key] > old[key]:
+                found.append('{scenario}@{size}: {key} {old} -> {new}'.format(
+                    key=key, old=old[key], new=r[key], **r))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES))
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds to delay every API call')
+    parser.add_argument(
+        '--scenarios', nargs='+',
+        help='run only scenarios with these prefixes')
+    parser.add_argument('--json', help='write the results in this file')
+    parser.add_argument(
+        '--baseline', help='fail if API calls grew since these results')
+    args = parser.parse_args()
+
+    results, row = [], '{:<28} {:>6} {:>9} {:>6} {:>6} {:>11} {:>6}  {}'
+    print(row.format(
+        'scenario', 'size', 'seconds', 'calls', 'lists', 'bytes', 'conns', ''))
+    for scenario in SCENARIOS:
+        if args.scenarios and not scenario[0].startswith(
+                tuple(args.scenarios)):
+            continue
+        for size in args.sizes:
+            r = run_scenario(scenario, size, args.latency)
+            results.append(r)
+            print(row.format(
+                r['scenario'], r['size'], r['seconds'], r['calls'],
+                r['list_calls'], r['bytes'], r['connections'],
+                r['error'] or ''))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f))
+        for line in found:
+            print('REGRESSION {}'.format(line))
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
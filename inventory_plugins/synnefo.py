@@ -0,0 +1,188 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: synnefo
+    plugin_type: inventory
+    short_description: Synnefo VMs, based on kamaki
+    description:
+        - List the VMs of a Synnefo cloud with one API call and group them by
+          project, network and status.
+        - Authentication and endpoints are resolved like in the cloud module.
+        - Uses a YAML configuration file ending with "synnefo.yml" or
+          "synnefo.yaml".
+    extends_documentation_fragment:
+        - constructed
+        - inventory_cache
+    options:
+        plugin:
+            description: token that ensures this is a source file for us
+            required: true
+            choices: ['synnefo']
+        url:
+            description: the cloud authentication (Astakos) url
+            required: true
+            env:
+                - name: SNF_URL
+        token:
+            description: the user token
+            required: true
+            env:
+                - name: SNF_TOKEN
+        project_id:
+            description: only list the VMs of this project
+        ca_certs:
+            description: certificates file, for secure connections
+        hostnames:
+            description: use VM names or ids as inventory hostnames
+            choices: ['name', 'id']
+            default: name
+'''
+
+EXAMPLES = '''
+# cloud.synnefo.yml
+plugin: synnefo
+url: https://astakos.okeanos-knossos.grnet.gr/identity/v2.0
+project_id: MY-PROJECT
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.cache/kamaki-ansible-role/inventory
+cache_timeout: 600
+keyed_groups:
+  - key: snf_flavor
+    prefix: flavor
+'''
+
+import os
+import ansible.module_utils
+from ansible.errors import AnsibleError
+from ansible.plugins.inventory import (
+    BaseInventoryPlugin, Constructable, Cacheable)
+
+# Ansible ships module_utils to the modules of a role, but does not put them
+# on the path of the controller, where inventory plugins run
+ROLE_MODULE_UTILS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'module_utils')
+if ROLE_MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(ROLE_MODULE_UTILS)
+
+try:
+    from kamaki.clients import ClientError
+    from kamaki.clients.astakos import AstakosClient
+    from kamaki.clients.cyclades import CycladesClient
+    from ansible.module_utils.snf_cache import SessionCache
+    from ansible.module_utils.snf_cloud import endpoint_catalog
+    from ansible.module_utils.snf_common import Transport
+    HAS_KAMAKI = True
+except ImportError:
+    HAS_KAMAKI = False
+
+
+def host_vars(vm):
+    """Keep what the inventory needs from a detailed VM record
+       Public (floating) IPv4s come first, they are used as ansible_host
+    """
+    attachments = vm.get('attachments') or []
+    floating = [a['ipv4'] for a in attachments if a.get('ipv4') and (
+        a.get('OS-EXT-IPS:type') == 'floating')]
+    fixed = [a['ipv4'] for a in attachments if a.get('ipv4') and (
+        a['ipv4'] not in floating)]
+    return dict(
+        snf_id='{}'.format(vm['id']),
+        snf_name=vm.get('name'),
+        snf_status=vm.get('status'),
+        snf_project=vm.get('tenant_id'),
+        snf_flavor=(vm.get('flavor') or dict()).get('id'),
+        snf_image=(vm.get('image') or dict()).get('id'),
+        snf_networks=sorted(set(
+            '{}'.format(a['network_id']) for a in attachments if (
+                a.get('network_id')))),
+        snf_ipv4s=floating + fixed,
+        snf_metadata=vm.get('metadata') or dict())
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+    """Synnefo inventory, with Ansible inventory caching
+       The cache keeps the host variables of every VM, so that a fresh cache
+       costs no API calls at all.
+    """
+    NAME = 'synnefo'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and (
+            path.endswith(('synnefo.yml', 'synnefo.yaml')))
+
+    def _list_servers(self):
+        """returns: the host variables of every VM"""
+        cloud = dict(
+            url=self.get_option('url'), token=self.get_option('token'))
+        try:
+            Transport.install(self.get_option('ca_certs'))
+            astakos = AstakosClient(cloud['url'], cloud['token'])
+            endpoints = endpoint_catalog(astakos, SessionCache(cloud))
+            compute = CycladesClient(endpoints['compute'], cloud['token'])
+            vms = compute.list_servers(detail=True)
+        except ClientError as e:
+            raise AnsibleError(
+                'Failed to list Synnefo VMs: {}'.format(e.message))
+        except KeyError:
+            raise AnsibleError('No compute endpoint in the Synnefo catalog')
+        project_id = self.get_option('project_id')
+        return [host_vars(vm) for vm in vms if (
+            not project_id or vm.get('tenant_id') == project_id)]
+
+    def _add_host(self, hostname, hostvars):
+        self.inventory.add_host(hostname)
+        if hostvars['snf_ipv4s']:
+            self.inventory.set_variable(
+                hostname, 'ansible_host', hostvars['snf_ipv4s'][0])
+        for key, value in hostvars.items():
+            self.inventory.set_variable(hostname, key, value)
+        groups = ['synnefo', 'status_{}'.format(hostvars['snf_status'])]
+        if hostvars['snf_project']:
+            groups.append('project_{}'.format(hostvars['snf_project']))
+        groups += ['network_{}'.format(n) for n in hostvars['snf_networks']]
+        for group in groups:
+            group = self.inventory.add_group(
+                self._sanitize_group_name(group.lower()))
+            self.inventory.add_child(group, hostname)
+        strict = self.get_option('strict')
+        self._set_composite_vars(
+            self.get_option('compose'), hostvars, hostname, strict=strict)
+        self._add_host_to_composed_groups(
+            self.get_option('groups'), hostvars, hostname, strict=strict)
+        self._add_host_to_keyed_groups(
+            self.get_option('keyed_groups'), hostvars, hostname,
+            strict=strict)
+
+    def _populate(self, servers):
+        by_name = self.get_option('hostnames') == 'name'
+        for hostvars in servers:
+            hostname = hostvars['snf_name'] if by_name else None
+            if not hostname or hostname in self.inventory.hosts:
+                hostname = hostvars['snf_id']
+            self._add_host(hostname, hostvars)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        if not HAS_KAMAKI:
+            raise AnsibleError(
+                'The synnefo inventory plugin requires kamaki and the role '
+                'module_utils (see README)')
+        self._read_config_data(path)
+        cache_key = self.get_cache_key(path)
+        use_cache = self.get_option('cache') and cache
+        update_cache = self.get_option('cache') and not cache
+        servers = None
+        if use_cache:
+            try:
+                servers = self._cache[cache_key]
+            except KeyError:
+                update_cache = True
+        if servers is None:
+            servers = self._list_servers()
+        if update_cache:
+            self._cache[cache_key] = servers
+        self._populate(servers)
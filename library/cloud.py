@@ -1,41 +1,117 @@
 #!/usr/bin/python
 # Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import os
 import re
+import time
 from kamaki.clients import ClientError
 from kamaki.clients.astakos import AstakosClient
-from kamaki.clients.utils import https
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_broker import BrokerClient, socket_name, spawn
+from ansible.module_utils.snf_cache import SessionCache, cache_dir
+from ansible.module_utils.snf_cloud import endpoint_catalog
+from ansible.module_utils.snf_common import Transport
+from ansible.module_utils.snf_fanout import (
+    fan_out, report, summary, target_name)
+from ansible.module_utils.snf_limit import Retrying, TokenBucket
+from ansible.module_utils.snf_trace import Tracer, Traced
 
 
 class SNFCloud(AnsibleModule):
     """Synnefo Cloud parent class
        Performs user authentication, kamaki SSL, project id check
        Designed to be imprted by other classes (e.g. compute, storage, etc.)
+       With "clouds", authenticate on many clouds (or projects) concurrently
     """
     _astakos = None
 
     def __init__(self, *args, **kw):
         super(SNFCloud, self).__init__(*args, **kw)
-        self._handle_ssl()
+        self.tracer = None
+        if self.params.get('api_stats') or self.params.get('api_trace'):
+            self.tracer = Tracer(
+                type(self).__name__, self.params.get('api_trace'))
+        if not self.params.get('clouds'):
+            self.bind()
+
+    def bind(self, target=None):
+        """Authenticate on the cloud of the parameters, updated by target"""
+        self.params.update(target or dict())
+        self._astakos = None
+        self.session = SessionCache(self.params)
+        self.broker = self._start_broker()
+        if not self.broker:
+            start = time.time()
+            self._handle_ssl()
+            if self.tracer:
+                self.tracer.record(
+                    'transport.install', time.time() - start)
+            Transport.throttle(TokenBucket.for_cloud(self.params))
         self._check_project_id()
 
+    def exit_json(self, **kwargs):
+        if self.tracer and self.params.get('api_stats'):
+            kwargs['api_stats'] = self.tracer.summary()
+        report(self, kwargs, False)
+        super(SNFCloud, self).exit_json(**kwargs)
+
+    def fail_json(self, **kwargs):
+        report(self, kwargs, True)
+        super(SNFCloud, self).fail_json(**kwargs)
+
+    def run(self):
+        """Authenticate and exit, on every cloud concurrently, if many
+           Each of "clouds" is a dict of cloud parameters (url, token,
+           project_id, etc.) and a "name", to tell results apart
+        """
+        clouds = self.params.get('clouds')
+        if not clouds:
+            self.exit_json(**self.present())
+        names = [target_name(target) for target in clouds]
+        if len(set(names)) != len(names):
+            self.fail_json(msg='Cloud names must be unique')
+
+        def _on(target):
+            self.bind(dict(
+                {k: v for k, v in target.items() if v is not None},
+                name=target_name(target)))
+            return self.present()
+        results = fan_out(self, clouds, _on)
+        result, error = summary(results)
+        result['clouds'] = [results[name]['cloud'] for name in names if (
+            not results[name].get('failed'))]
+        if error:
+            self.fail_json(msg=error, **result)
+        self.exit_json(**result)
+
     # General purpose SNF methods and properties
     def _handle_ssl(self):
-        ca_certs = self.params.get('ca_certs')
-        if ca_certs:
-            try:
-                https.patch_with_certs(ca_certs)
-            except Exception as e:
-                self.fail_json(
-                    msg="Certificates (ca_certs) failed to patch kamaki",
-                    msg_details="{}".format(e))
-        else:
-            https.patch_ignore_ssl()
+        try:
+            Transport.install(self.params.get('ca_certs'))
+        except Exception as e:
+            self.fail_json(
+                msg="Certificates (ca_certs) failed to patch kamaki",
+                msg_details="{}".format(e))
+
+    def _start_broker(self):
+        """Start a broker, unless one is running (see snf_broker)
+           returns: the broker socket, or None
+        """
+        if not self.params.get('broker'):
+            return None
+        path = self.params.get('broker_socket') or os.path.join(
+            cache_dir(self.params), socket_name(
+                self.params.get('url'), self.params.get('token'),
+                self.params.get('ca_certs')))
+        if spawn(path, self.params.get('broker_idle'),
+                 self.params.get('ca_certs')):
+            return path
+        self.warn('Broker did not start on {}, running without'.format(path))
+        return None
 
     def _check_project_id(self):
         """returns: True if project id is there and active, False, otherwise"""
         project_id = self.params.get('project_id')
-        if project_id:
+        if project_id and not self.session.project(project_id):
             try:
                 project = self.astakos.get_project(project_id)
             except ClientError as e:
@@ -44,35 +120,70 @@ class SNFCloud(AnsibleModule):
             if project['state'] != 'active':
                 msg = 'Project {id} is inactive (state: {state})'
                 self.fail_json(msg=msg.format(
-                    pname=project['name'], state=project['state']))
+                    id=project_id, state=project['state']))
+            self.session.save_project(dict(
+                id=project_id, name=project['name'], state=project['state']))
         return project_id
 
     @property
     def astakos(self):
         if not self._astakos:
             try:
-                self._astakos = AstakosClient(
-                    self.params.get('url'),
-                    self.params.get('token'))
+                if self.broker:
+                    self._astakos = BrokerClient(
+                        self.broker, 'astakos', self.params)
+                else:
+                    self._astakos = AstakosClient(
+                        self.params.get('url'),
+                        self.params.get('token'))
             except ClientError as e:
                 self.fail_json(
                     msg="Astakos Client initialization failed",
                     msg_details=e.message)
+            if self.tracer:
+                self._astakos = Traced(self._astakos, self.tracer, 'astakos')
+            if self.params.get('retries'):
+                self._astakos = Retrying(
+                    self._astakos, self.params.get('retries'))
         return self._astakos
 
     def get_api_url(self, api):
+        url = self.session.endpoints.get(api)
+        if url:
+            return url
         try:
-            return self.astakos.get_endpoint_url(api)
+            url = self.astakos.get_endpoint_url(api)
         except ClientError as e:
-            module.fail_json(
+            self.fail_json(
                 msg="{} api endpoint retrieval failed".format(api),
                 msg_details=e.message)
+        self.session.save_endpoints({api: url})
+        return url
+
+    def get_endpoints(self):
+        """Resolve the endpoints of every service in one authentication
+           returns: {service type: public url}
+        """
+        try:
+            return endpoint_catalog(self.astakos, self.session)
+        except ClientError as e:
+            self.fail_json(
+                msg="Endpoint catalog retrieval failed",
+                msg_details=e.message)
 
     def present(self):
-        cloud = {key: module.params.get(key) for key in (
-            'url', 'token', 'project_id', 'ca_certs')}
-        cloud['compute_url'] = self.get_api_url('compute')
-        cloud['network_url'] = self.get_api_url('network')
+        cloud = {key: self.params.get(key) for key in (
+            'url', 'token', 'project_id', 'ca_certs',
+            'cache_dir', 'cache_ttl', 'cache_size', 'catalog_ttl',
+            'rate_limit', 'rate_burst', 'retries')}
+        cloud['broker'], cloud['name'] = self.broker, self.params.get('name')
+        if self.params.get('all_endpoints'):
+            cloud['endpoints'] = self.get_endpoints()
+            cloud['compute_url'] = cloud['endpoints'].get('compute')
+            cloud['network_url'] = cloud['endpoints'].get('network')
+        else:
+            cloud['compute_url'] = self.get_api_url('compute')
+            cloud['network_url'] = self.get_api_url('network')
         return dict(changed=True, cloud=cloud)
 
 
@@ -80,10 +191,44 @@ if __name__ == '__main__':
     module = SNFCloud(
         argument_spec={
             'ca_certs': {'required': False, 'type': 'str'},
-            'url': {'required': True, 'type': 'str'},
-            'token': {'required': True, 'type': 'str'},
+            'url': {'required': False, 'type': 'str'},
+            'token': {'required': False, 'type': 'str'},
+            'name': {'required': False, 'type': 'str'},
+            'clouds': {
+                'required': False, 'type': 'list', 'elements': 'dict',
+                'options': {
+                    'url': {'required': True, 'type': 'str'},
+                    'token': {'required': True, 'type': 'str'},
+                    'name': {'required': False, 'type': 'str'},
+                    'project_id': {'required': False, 'type': 'str'},
+                    'ca_certs': {'required': False, 'type': 'str'},
+                    'cache_dir': {'required': False, 'type': 'path'},
+                    'cache_ttl': {'required': False, 'type': 'int'},
+                    'cache_size': {'required': False, 'type': 'int'},
+                    'catalog_ttl': {'required': False, 'type': 'int'},
+                    'rate_limit': {'required': False, 'type': 'float'},
+                    'rate_burst': {'required': False, 'type': 'int'},
+                    'retries': {'required': False, 'type': 'int'},
+                }},
             'project_id': {'required': False, 'type': 'str'},
+            'cache_dir': {'required': False, 'type': 'path'},
+            'cache_ttl': {'default': 0, 'type': 'int'},
+            'cache_size': {'default': 10000, 'type': 'int'},
+            'catalog_ttl': {'default': 3600, 'type': 'int'},
+            'all_endpoints': {'default': False, 'type': 'bool'},
+            'rate_limit': {'default': 0, 'type': 'float'},
+            'rate_burst': {'default': 10, 'type': 'int'},
+            'retries': {'default': 3, 'type': 'int'},
+            'broker': {'default': False, 'type': 'bool'},
+            'broker_socket': {'required': False, 'type': 'path'},
+            'broker_idle': {'default': 600, 'type': 'int'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
         },
-        required_if=(('state', 'connected', ('vm_id', )), )
+        required_if=(('state', 'connected', ('vm_id', )), ),
+        required_one_of=(('url', 'clouds'), ),
+        required_together=(('url', 'token'), ),
+        mutually_exclusive=(('url', 'clouds'), ),
+        supports_check_mode=True,
     )
-    module.exit_json(**module.present())
+    module.run()
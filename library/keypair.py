@@ -1,103 +1,175 @@
 #!/usr/bin/python
 # Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
 from kamaki.clients import ClientError
-from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
-from kamaki.cli import logging
-from kamaki.clients.utils import https
 from datetime import datetime
 import uuid
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_common import (
+    SNFModule, key_fingerprint, with_fingerprint)
 
 
-class SNFKeypair(AnsibleModule):
-    """Synnefo keypair class, based on kamaki handles PPK pairs"""
-    _compute = None
+def key_name(name=None):
+    return name or 'ansible-autogen_{:%m_%d_%H_%M_%S_%f}_{uniq}'.format(
+        datetime.now(), uniq=str(uuid.uuid4())[:8])
 
-    def __init__(self, *args, **kw):
-        super(SNFKeypair, self).__init__(*args, **kw)
-        self.cloud = self.params.get('cloud').get('cloud')
-        ca_certs = self.cloud.get('ca_certs')
-        if ca_certs:
+
+class SNFKeypair(SNFModule):
+    """Synnefo keypair class, based on kamaki handles PPK pairs
+       Public keys are matched by fingerprint, so that comments and
+       whitespace do not matter
+    """
+    _pairs = None
+
+    def list_keypairs(self):
+        """returns: keypairs, listed at most once per run"""
+        if self._pairs is None:
+            self._pairs = self.cache.listing('keypairs')
+        if self._pairs is None:
             try:
-                https.patch_with_certs(ca_certs)
-            except Exception as e:
-                self.fail_json(
-                    msg="Certificates (ca_certs) failed to patch kamaki",
-                    msg_details=e.message)
-        else:
-            https.patch_ignore_ssl()
+                self._pairs = [with_fingerprint(k) for k in (
+                    self.compute.list_keypairs())]
+            except ClientError as e:
+                self.fail_json(msg='Error listing keys', msg_details=e.message)
+            self.cache.store('keypairs', self._pairs)
+        return self._pairs
+
+    def find_key(self, public_key):
+        """returns: the keypair with this public key, or None"""
+        fingerprint = key_fingerprint(public_key)
+        if not fingerprint:
+            matching = [k for k in self.list_keypairs() if (
+                k['public_key'].strip() == public_key.strip())]
+            return matching[0] if matching else None
+        hit, pair = self.cache.lookup('keypairs', 'fingerprint', fingerprint)
+        if hit:
+            return pair
+        matching = [k for k in self.list_keypairs() if (
+            key_fingerprint(k['public_key']) == fingerprint)]
+        return matching[0] if matching else None
 
     def discover(self):
         name = self.params.get('name')
         if name:
+            pair = self.cache.get('keypairs', name)
+            if pair:
+                return pair
             try:
-                return self.compute.get_keypair_details(name)
+                pair = with_fingerprint(
+                    self.compute.get_keypair_details(name))
+                self.cache.put('keypairs', pair)
+                return pair
             except ClientError as e:
                 if e.status not in (404, ):
                     self.fail_json(
                         msg='Error searching key', msg_details=e.message)
         public_key = self.params.get('public_key')
         if public_key:
-            try:
-                keypairs = self.compute.list_keypairs()
-            except ClientError as e:
-                self.fail_json(msg='Error listing keys', msg_details=e.message)
-            matching = [k for k in keypairs if k['public_key'] == public_key]
-            return matching[0] if matching else None
+            return self.find_key(public_key)
         return None
 
+    def _create(self, name=None, public_key=None):
+        pair = self.compute.create_key(
+            key_name=key_name(name), public_key=public_key)
+        self.cache.put('keypairs', with_fingerprint(pair))
+        return pair
+
     def create(self):
-        name = self.params.get('name')
-        name = name or 'ansible-autogen_{:%m_%d_%H_%M_%S_%f}_{uniq}'.format(
-            datetime.now(), uniq=str(uuid.uuid4())[:8])
+        public_key = self.params.get('public_key')
+        if self.plan('create', 'keypair', name=self.params.get('name'),
+                     fingerprint=key_fingerprint(public_key)):
+            return None
         try:
-            return self.compute.create_key(
-                key_name=name, public_key=self.params.get('public_key'))
+            return self._create(self.params.get('name'), public_key)
         except ClientError as e:
             self.fail_json(
                 msg='Failed to upload public key', msg_details=e.message)
 
+    def _upload(self, item):
+        return self._create(item.get('name'), item['public_key'])
+
+    def batch(self):
+        """returns: [{'public_key': ..., 'name': ...}] from "public_keys",
+           which may be public keys or dicts with a public_key and a name
+        """
+        items = [k if isinstance(k, dict) else dict(public_key=k) for k in (
+            self.params.get('public_keys'))]
+        for item in items:
+            if not item.get('public_key'):
+                self.fail_json(msg='No public_key in {}'.format(item))
+        return items
+
     # State functions
     def present(self):
+        if self.params.get('public_keys'):
+            return self.batch_present(self.batch())
         pair = self.discover()
         return dict(changed=not pair, keypair=pair or self.create())
 
+    def batch_present(self, items):
+        """Make sure all public keys are uploaded, with one listing and
+           concurrent uploads of the missing ones
+        """
+        def _key(item):
+            return key_fingerprint(item['public_key']) or (
+                item['public_key'].strip())
+        pairs = [self.find_key(item['public_key']) for item in items]
+        missing = list({_key(item): item for item, pair in reversed(list(
+            zip(items, pairs))) if not pair}.values())
+        if self.check_mode:
+            for item in missing:
+                self.plan('create', 'keypair', name=item.get('name'),
+                          fingerprint=key_fingerprint(item['public_key']))
+            return dict(changed=bool(missing), keypairs=pairs)
+        results = self.run_parallel(self._upload, missing)
+        uploaded = {_key(item): pair for item, (pair, _) in zip(
+            missing, results)}
+        pairs = [pair or uploaded.get(_key(item)) for item, pair in zip(
+            items, pairs)]
+        errors = ['{}: {}'.format(
+            item.get('name') or key_fingerprint(item['public_key']),
+            e.message) for item, (_, e) in zip(missing, results) if e]
+        if errors:
+            self.fail_json(
+                msg='Failed to upload {} of {} keys'.format(
+                    len(errors), len(missing)),
+                msg_details='; '.join(errors),
+                keypairs=[pair for pair in pairs if pair])
+        return dict(changed=bool(missing), keypairs=pairs)
+
     def absent(self):
         pair = self.discover()
+        if pair and self.plan('delete', 'keypair', name=pair['name']):
+            return dict(changed=True, msg='Keypair would be deleted')
         if pair:
             try:
                 self.compute.delete_keypair(pair['name'])
             except ClientError as e:
                 self.fail_json(
                     msg='Failed to delete keypair', msg_details=e.message)
+            self.cache.drop('keypairs', pair['name'])
             return dict(changed=True, msg='Keypair deleted')
         return dict(changed=False, msg='No such keypair')
 
-    # General purpose SNF methods and properties
-    @property
-    def compute(self):
-        if not self._compute:
-            url, token = self.cloud.get('compute_url'), self.cloud.get('token')
-            try:
-                self._compute = CycladesClient(url, token)
-            except ClientError as e:
-                module.fail_json(
-                    msg="Compute Client initialization failed",
-                    msg_details=e.message)
-        return self._compute
-
 
 if __name__ == '__main__':
     module = SNFKeypair(
         argument_spec={
             'state': {'default': 'present', 'choices': ['present', 'absent']},
             'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
             'public_key': {'reuired': False, 'type': 'str'},
             'name': {'required': False, 'type': 'str'},
-        }
+            'public_keys': {'required': False, 'type': 'list'},
+            'workers': {'default': 10, 'type': 'int'},
+            'facts': {'required': False, 'type': 'dict'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        mutually_exclusive=(
+            ('public_keys', 'public_key'), ('public_keys', 'name')),
+        supports_check_mode=True,
     )
-    result = {
+    module.run({
         'present': module.present,
         'absent': module.absent,
-    }[module.params['state']]()
-    module.exit_json(**result)
+    }[module.params['state']])
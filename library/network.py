@@ -1,60 +1,39 @@
 #!/usr/bin/python
 # Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
 from kamaki.clients import ClientError
-from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
-from kamaki.clients.network import NetworkClient
-from kamaki.cli import logging
-from kamaki.clients.utils import https
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_wait import until, while_
 
 
-class SNFPrivateNetwork(AnsibleModule):
+class SNFPrivateNetwork(SNFModule):
     """Synnefo network class, based on kamaki
        Create, delete, start, stop, reboot, etc. a private network
     """
-    _cyclades, _network = None, None
-
-    def __init__(self, *args, **kw):
-        super(SNFPrivateNetwork, self).__init__(*args, **kw)
-        self.cloud = self.params.get('cloud').get('cloud')
-        ca_certs = self.cloud.get('ca_certs')
-        if ca_certs:
-            try:
-                https.patch_with_certs(ca_certs)
-            except Exception as e:
-                self.fail_json(
-                    msg="Certificates (ca_certs) failed to patch kamaki",
-                    msg_details=e.message)
-        else:
-            https.patch_ignore_ssl()
-
-    @property
-    def network(self):
-        if not self._network:
-            url, token = self.cloud.get('network_url'), self.cloud.get('token')
-            try:
-                self._network = CycladesNetworkClient(url, token)
-            except ClientError as e:
-                self.fail_json(
-                    msg="Network Client initialization failed",
-                    msg_details=e.message)
-        return self._network
+    _ports = None
 
     def discover(self):
         id_, name = self.params.get('id'), self.params.get('name')
         if id_:
+            net = self.cache.get('networks', id_)
+            if net:
+                return net
             try:
-                return self.network.get_network_details(id_)
+                net = self.network.get_network_details(id_)
             except ClientError as e:
                 if e.status in (404, ):
                     return None
                 self.fail_json(
                     msg='Error while looking for network',
                     msg_details=e.message)
+            self.cache.put('networks', net)
+            return net
         elif name:
-            for net in self.network.list_networks(detail=True):
-                if name == net['name']:
-                    return net
+            try:
+                return self.find('networks', name)
+            except ClientError as e:
+                self.fail_json(
+                    msg='Error while looking for network',
+                    msg_details=e.message)
         return None
 
     def create_subnet(self, id_):
@@ -67,27 +46,56 @@ class SNFPrivateNetwork(AnsibleModule):
 
     def create(self):
         name = self.params.get('name')
+        if self.plan('create', 'network', name=name):
+            return dict(id=None, name=name, subnets=[])
         try:
-            return self.network.create_network(
+            net = self.network.create_network(
                 type='MAC_FILTERED', name=name,
                 project_id=self.cloud.get('project_id'))
         except ClientError as e:
             self.fail_json(
                 msg="Failed to create network with name {}".format(name),
                 msg_details=e.message)
+        self.cache.put('networks', net)
+        return net
+
+    def port_index(self, net_id):
+        """Index the ports of a network by VM, with at most one listing
+           returns: {vm_id: port}
+        """
+        if self._ports is None:
+            ports = self.cache.listing('ports')
+            if ports is None:
+                try:
+                    ports = self.network.list_ports()
+                except ClientError as e:
+                    self.fail_json(
+                        msg='Failed to list ports', msg_details=e.message)
+                self.cache.store('ports', ports)
+            self._ports = {'{}'.format(port['device_id']): port for port in (
+                ports) if '{}'.format(port['network_id']) == net_id}
+        return self._ports
+
+    def discover_port(self, net_id, vm_id=None):
+        vm_id = vm_id or self.params.get('vm_id')
+        return self.port_index(net_id).get('{}'.format(vm_id))
 
-    def discover_port(self, net_id):
+    def vm_ids(self):
+        """returns: the VMs to (dis)connect, from "vm_ids" or "vm_id" """
+        return ['{}'.format(vm_id) for vm_id in (
+            self.params.get('vm_ids') or [self.params.get('vm_id')])]
+
+    def _create_port(self, item):
+        net_id, vm_id = item
+        return self.network.create_port(net_id, vm_id)
+
+    def _delete_port(self, port):
         try:
-            ports = self.network.list_ports()
+            self.network.delete_port(port['id'])
         except ClientError as e:
-            self.fail_json(
-                msg='Failed to list ports', msg_details=e.message)
-        vm_id = self.params.get('vm_id')
-        for port in ports:
-            if all((
-                    port['device_id'] == vm_id,
-                    port['network_id'] == net_id)):
-                return port
+            if e.status not in (404, ):
+                raise
+        return port
 
     # state functions
     def absent(self):
@@ -95,7 +103,11 @@ class SNFPrivateNetwork(AnsibleModule):
            Networks are identified by id or name, in that order
         """
         net = self.discover()
+        if net and self.plan(
+                'delete', 'network', id=net['id'], name=net['name']):
+            return dict(changed=True, msg='Network would be deleted')
         if net:
+            self.cache.drop('networks', net['id'])
             try:
                 self.network.delete_network(net['id'])
                 return dict(changed=True, msg='Network deleted')
@@ -118,54 +130,96 @@ class SNFPrivateNetwork(AnsibleModule):
         if not net:
             net = self.create()
             changed = True
-        if name and net['name'] != name:
+        if name and net['name'] != name and self.plan(
+                'rename', 'network', id=net['id'], name=net['name'],
+                new_name=name):
+            changed = True
+        elif name and net['name'] != name:
             try:
                 net = self.network.update_network(net['id'], name=name)
             except ClientError as e:
                 self.fail_json(
                     msg="Failed to update network", msg_details=e.message)
             changed = True
-        if self.params.get('cidr') and not net['subnets']:
+            self.cache.put('networks', net)
+        cidr = self.params.get('cidr')
+        if cidr and not net['subnets'] and self.plan(
+                'create', 'subnet', network_id=net['id'], name=net['name'],
+                cidr=cidr):
+            changed = True
+        elif cidr and not net['subnets']:
             subnet = self.create_subnet(net['id'])
             net['subnets'].append(subnet['id'])
             changed = True
+            self.cache.put('networks', net)
         return dict(changed=changed, network=net)
 
     def connected(self):
-        net, vm_id = self.discover(), self.params.get('vm_id')
+        """Make sure VMs are connected to the network, connect the missing
+           ones concurrently and wait for all ports together
+        """
+        net, vm_ids = self.discover(), self.vm_ids()
         if not net:
             self.fail_json(msg='Network does not exist')
-        port = self.discover_port(net['id'])
-        if port:
-            return dict(changed=False, port=port)
-        try:
-            port = self.network.create_port(net['id'], vm_id)
-        except ClientError as e:
+        index = self.port_index('{}'.format(net['id']))
+        missing = [(net['id'], vm_id) for vm_id in vm_ids if (
+            vm_id not in index)]
+        if self.check_mode:
+            for _, vm_id in missing:
+                self.plan('attach', 'network', id=net['id'], name=net['name'],
+                          vm_id=vm_id)
+            missing = []
+        results = self.run_parallel(self._create_port, missing)
+        created = [port for port, _ in results if port]
+        for port in created:
+            self.cache.put('ports', port)
+            self.cache.stale('servers', port['device_id'])
+        for port in self.wait_ports(created, until('ACTIVE')):
+            index['{}'.format(port['device_id'])] = port
+        errors = ['{}: {}'.format(vm_id, e.message) for (_, vm_id), (
+            _, e) in zip(missing, results) if e]
+        ports = [index.get(vm_id) for vm_id in vm_ids]
+        if errors:
             self.fail_json(
-                msg='Failed to connect network', msg_details=e.message)
-        if self.params.get('wait'):
-            try:
-                port = self.network.wait_port_until(port['id'], 'ACTIVE')
-            except ClientError as e:
-                pass
-        return dict(changed=True, port=port)
+                msg='Failed to connect {} of {} VMs'.format(
+                    len(errors), len(missing)),
+                msg_details='; '.join(errors),
+                ports=[port for port in ports if port])
+        changed = bool(created or self.changes)
+        if self.params.get('vm_ids'):
+            return dict(changed=changed, ports=ports)
+        return dict(changed=changed, port=ports[0])
 
     def disconnected(self):
-        net = self.discover()
+        """Make sure VMs are not connected to the network, delete their ports
+           concurrently and wait for all of them together
+        """
+        net, vm_ids = self.discover(), self.vm_ids()
         if not net:
             self.fail_json(msg='Network does not exist')
-        port = self.discover_port(net['id'])
-        if not port:
+        index = self.port_index('{}'.format(net['id']))
+        ports = [index[vm_id] for vm_id in vm_ids if vm_id in index]
+        if not ports:
             return dict(changed=False, msg='No connection')
-        try:
-            self.network.delete_port(port['id'])
-        except ClientError as e:
-            self.fail_json(msg='Failed to delete port', msg_details=e.message)
-        if self.params.get('wait'):
-            try:
-                self.network.wait_port_while(port['id'], 'ACTIVE')
-            except ClientError:
-                pass
+        if self.check_mode:
+            for port in ports:
+                self.plan('detach', 'network', id=net['id'], name=net['name'],
+                          vm_id=port['device_id'], port_id=port['id'])
+            return dict(changed=True, msg='VMs would be disconnected')
+        results = self.run_parallel(self._delete_port, ports)
+        deleted = [port for port, _ in results if port]
+        for port in deleted:
+            self.cache.drop('ports', port['id'])
+            self.cache.stale('servers', port['device_id'])
+            index.pop('{}'.format(port['device_id']), None)
+        self.wait_ports(deleted, while_('ACTIVE'))
+        errors = ['{}: {}'.format(port['device_id'], e.message) for port, (
+            _, e) in zip(ports, results) if e]
+        if errors:
+            self.fail_json(
+                msg='Failed to disconnect {} of {} VMs'.format(
+                    len(errors), len(ports)),
+                msg_details='; '.join(errors))
         return dict(changed=True, msg='Disconnected succesfully')
 
 
@@ -176,23 +230,32 @@ if __name__ == '__main__':
                 'default': 'present',
                 'choices': ['absent', 'present', 'connected', 'disconnected']},
             'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
             'id': {'required': False, 'type': 'str'},
             'name': {'required': False, 'type': 'str'},
             'cidr': {'required': False, 'type': 'str'},
             'dhcp': {'required': False, 'type': 'bool'},
             'vm_id': {'required': False, 'type': 'str'},
+            'vm_ids': {'required': False, 'type': 'list'},
+            'workers': {'default': 10, 'type': 'int'},
+            'facts': {'required': False, 'type': 'dict'},
             'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
         },
         required_if=(
             ('dhcp', True, ('cidr', )),
-            ('state', 'connected', ('vm_id', )),
-            ('state', 'disconnected', ('vm_id', )),
+            ('state', 'connected', ('vm_id', 'vm_ids'), True),
+            ('state', 'disconnected', ('vm_id', 'vm_ids'), True),
         ),
+        mutually_exclusive=(('vm_id', 'vm_ids'), ),
+        supports_check_mode=True,
     )
-    result = {
+    module.run({
         'absent': module.absent,
         'present': module.present,
         'connected': module.connected,
         'disconnected': module.disconnected,
-    }[module.params['state']]()
-    module.exit_json(**result)
+    }[module.params['state']])
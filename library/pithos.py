@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from kamaki.clients import ClientError
+from kamaki.clients.pithos import PithosClient
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_pithos import (
+    DEFAULT_BLOCK_HASH, DEFAULT_BLOCK_SIZE, MappedFile, block_hash)
+
+# Hashmap uploads, in case blocks go missing while uploading the others
+UPLOAD_ROUNDS = 3
+
+
+class SNFPithos(SNFModule):
+    """Synnefo object storage (Pithos) class, based on kamaki
+       Files are uploaded as hashmaps: their blocks are hashed locally and
+       concurrently, and only the blocks the server is missing are sent,
+       concurrently, so that re-uploading a modified file costs only its
+       changed blocks.
+    """
+
+    def setup(self):
+        self.container, self.name = (
+            self.params.get('container'), self.params.get('name'))
+        try:
+            url = self.cloud.get('pithos_url') or self.endpoint(
+                'object-store')
+            self.account = self.params.get('account') or (
+                self.authenticate()['user']['id'])
+        except ClientError as e:
+            self.fail_json(msg='Failed to authenticate', msg_details=e.message)
+        if not url:
+            self.fail_json(msg='No object-store endpoint in the cloud')
+        self.cloud = dict(self.cloud, pithos_url=url)
+
+    @property
+    def pithos(self):
+        return self._client(
+            'pithos', PithosClient, 'pithos_url', account=self.account,
+            container=self.container)
+
+    def container_info(self):
+        """Create the container if missing
+           returns: the container headers, or an empty dict in check mode
+        """
+        try:
+            return self.pithos.get_container_info()
+        except ClientError as e:
+            if e.status not in (404, ):
+                self.fail_json(
+                    msg='Error while looking up container',
+                    msg_details=e.message)
+        if self.plan('create', 'container', name=self.container):
+            return dict()
+        try:
+            self.pithos.create_container(
+                self.container, project_id=self.cloud.get('project_id'))
+            return self.pithos.get_container_info()
+        except ClientError as e:
+            self.fail_json(
+                msg='Failed to create container', msg_details=e.message)
+
+    def remote_hashmap(self):
+        """returns: the hashmap of the object, or None if it does not exist"""
+        try:
+            return self.pithos.get_object_hashmap(self.name)
+        except ClientError as e:
+            if e.status in (404, ):
+                return None
+            self.fail_json(
+                msg='Error while looking up object', msg_details=e.message)
+
+    def hashmap(self, mapped, algorithm):
+        """returns: the hashes of the blocks of a mapped file, in order"""
+        results = self.run_parallel(
+            lambda i: block_hash(mapped.block(i), algorithm),
+            list(range(mapped.blocks)))
+        return [hash_ for hash_, _ in results]
+
+    def _put_block(self, data, hash_):
+        r = self.pithos.container_post(
+            update=True, content_type='application/octet-stream',
+            content_length=len(data), data=data, format='json')
+        if r.json[0] != hash_:
+            raise ClientError('Block {} was stored as {}'.format(
+                hash_, r.json[0]), 0)
+        return len(data)
+
+    def upload(self, mapped, hashes):
+        """Create the object from its hashmap, send the missing blocks
+           concurrently, until the server has them all
+           returns: the number of blocks and bytes sent
+        """
+        first = dict()
+        for index, hash_ in enumerate(hashes):
+            first.setdefault(hash_, index)
+        sent, sent_bytes = 0, 0
+        for _ in range(UPLOAD_ROUNDS):
+            try:
+                r = self.pithos.object_put(
+                    self.name, format='json', hashmap=True,
+                    content_type=self.params.get('content_type'),
+                    json=dict(bytes=mapped.size, hashes=hashes),
+                    success=(201, 409))
+            except ClientError as e:
+                self.fail_json(
+                    msg='Failed to upload object', msg_details=e.message)
+            if r.status_code == 201:
+                return sent, sent_bytes
+            missing = [hash_ for hash_ in r.json if hash_ in first]
+            results = self.run_parallel(
+                lambda hash_: self._put_block(
+                    mapped.block(first[hash_]), hash_), missing)
+            errors = [e.message for _, e in results if e]
+            if errors:
+                self.fail_json(
+                    msg='Failed to upload {} of {} blocks'.format(
+                        len(errors), len(missing)),
+                    msg_details='; '.join(errors))
+            sent += len(missing)
+            sent_bytes += sum(size for size, _ in results)
+        self.fail_json(msg='Blocks kept missing after {} uploads'.format(
+            UPLOAD_ROUNDS))
+
+    # State functions
+    def present(self):
+        """Upload "src" as the object, unless it is already there"""
+        info = self.container_info()
+        block_size = int(
+            info.get('x-container-block-size') or DEFAULT_BLOCK_SIZE)
+        algorithm = info.get('x-container-block-hash') or DEFAULT_BLOCK_HASH
+        try:
+            mapped = MappedFile(self.params.get('src'), block_size)
+        except (IOError, OSError) as e:
+            self.fail_json(msg='Cannot read src', msg_details='{}'.format(e))
+        with mapped:
+            hashes = self.hashmap(mapped, algorithm)
+            remote = self.remote_hashmap() if info else None
+            obj = dict(
+                container=self.container, name=self.name, bytes=mapped.size,
+                blocks=len(hashes), uploaded_blocks=0, uploaded_bytes=0)
+            if remote and remote.get('hashes') == hashes and (
+                    int(remote.get('bytes', -1)) == mapped.size):
+                return dict(changed=False, object=obj)
+            if self.plan(
+                    'upload', 'object', container=self.container,
+                    name=self.name, bytes=mapped.size, blocks=len(set(
+                        hashes).difference((remote or dict()).get(
+                            'hashes') or []))):
+                return dict(changed=True, object=obj)
+            obj['uploaded_blocks'], obj['uploaded_bytes'] = self.upload(
+                mapped, hashes)
+        return dict(changed=True, object=obj)
+
+    def absent(self):
+        try:
+            self.pithos.get_object_info(self.name)
+        except ClientError as e:
+            if e.status in (404, ):
+                return dict(changed=False, msg='No such object')
+            self.fail_json(
+                msg='Error while looking up object', msg_details=e.message)
+        if self.plan(
+                'delete', 'object', container=self.container, name=self.name):
+            return dict(changed=True, msg='Object to delete')
+        try:
+            self.pithos.delete_object(self.name)
+        except ClientError as e:
+            self.fail_json(
+                msg='Failed to delete object', msg_details=e.message)
+        return dict(changed=True, msg='Object deleted')
+
+
+if __name__ == '__main__':
+    module = SNFPithos(
+        argument_spec={
+            'state': {'default': 'present', 'choices': ['present', 'absent']},
+            'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
+            'container': {'default': 'pithos', 'type': 'str'},
+            'name': {'required': True, 'type': 'str'},
+            'src': {'required': False, 'type': 'path'},
+            'content_type': {
+                'default': 'application/octet-stream', 'type': 'str'},
+            'account': {'required': False, 'type': 'str'},
+            'workers': {'default': 10, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        required_if=(('state', 'present', ('src', )), ),
+        supports_check_mode=True,
+    )
+    module.run({
+        'present': module.present,
+        'absent': module.absent,
+    }[module.params['state']])
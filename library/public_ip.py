@@ -1,91 +1,120 @@
 #!/usr/bin/python
 # Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
 from kamaki.clients import ClientError
-from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
-from kamaki.clients.network import NetworkClient
-from kamaki.cli import logging
-from kamaki.clients.utils import https
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_wait import until, while_
 
 
-class SNFPublicIP(AnsibleModule):
+class SNFPublicIP(SNFModule):
     """Synnefo network class, based on kamaki
        Create, delete, start, stop, reboot, etc. a private network
     """
-    _cyclades, _network = None, None
-
-    def __init__(self, *args, **kw):
-        super(SNFPublicIP, self).__init__(*args, **kw)
-        self.cloud = self.params.get('cloud').get('cloud')
-        ca_certs = self.cloud.get('ca_certs')
-        if ca_certs:
-            try:
-                https.patch_with_certs(ca_certs)
-            except Exception as e:
-                self.fail_json(
-                    msg="Certificates (ca_certs) failed to patch kamaki",
-                    msg_details=e.message)
-        else:
-            https.patch_ignore_ssl()
-
-    @property
-    def network(self):
-        if not self._network:
-            url, token = self.cloud.get('network_url'), self.cloud.get('token')
-            try:
-                self._network = CycladesNetworkClient(url, token)
-            except ClientError as e:
-                self.fail_json(
-                    msg="Network Client initialization failed",
-                    msg_details=e.message)
-        return self._network
 
     def discover(self):
         """Discover the IP with given IP or address"""
         id_, address = self.params.get('id'), self.params.get('address')
         if id_:
+            ip = self.cache.get('floatingips', id_)
+            if ip:
+                return ip
             try:
-                return self.network.get_floatingip_details(id_)
+                ip = self.network.get_floatingip_details(id_)
             except ClientError as e:
                 if e.status in (404, ):
                     return None
                 self.fail_json(
                     msg='Error while looking for ip', msg_details=e.message)
+            self.cache.put('floatingips', ip)
+            return ip
         elif address:
-            for ip in self.network.list_floatingips():
+            hit, ip = self.cache.lookup(
+                'floatingips', 'floating_ip_address', address)
+            if hit:
+                return ip
+            for ip in self.list_floatingips():
                 if address == ip['floating_ip_address']:
                     return ip
         return None
 
+    def list_floatingips(self):
+        """returns: floating IPs, from the cache if it has a fresh listing"""
+        ips = self.cache.listing('floatingips')
+        if ips is None:
+            ips = self.network.list_floatingips()
+            self.cache.store('floatingips', ips)
+        return ips
+
+    def _reserve(self, address=None):
+        ip = self.network.create_floatingip(
+            floating_ip_address=address,
+            project_id=self.cloud.get('project_id'))
+        self.cache.put('floatingips', ip)
+        return ip
+
     def reserve(self):
         """Reserve a new floating IP from the pool"""
+        address = self.params.get('address')
+        if self.plan('create', 'floatingip', floating_ip_address=address):
+            return None
         try:
-            return self.network.create_floatingip(
-                floating_ip_address=self.params.get('address'),
-                project_id=self.cloud.get('project_id'))
+            return self._reserve(address)
         except ClientError as e:
             self.fail_json(
                 msg="Failed to create floating IP", msg_details=e.message)
 
-    def next_available(self):
-        """Get the next available IP, or reserve a new one"""
+    def available(self, count):
+        """Get count free IPs from one listing, reserve the shortfall
+           concurrently. Also keep "pool_size" more IPs reserved and free,
+           for the next tasks to use.
+           returns: a list of count IPs
+        """
         try:
-            ips = filter(
-                lambda ip: not ip['port_id'], self.network.list_floatingips())
+            free = [ip for ip in self.list_floatingips() if not ip['port_id']]
         except ClientError as e:
-            self.fail_json('Error while looking for free ips')
-        if ips:
-            return ips[0]
-        return self.reserve()
+            self.fail_json(
+                msg='Error while looking for free IPs', msg_details=e.message)
+        shortfall = count + (self.params.get('pool_size') or 0) - len(free)
+        if self.check_mode:
+            for _ in range(max(0, shortfall)):
+                self.plan('create', 'floatingip')
+            return free[:count]
+        results = self.run_parallel(
+            lambda _: self._reserve(), range(max(0, shortfall)))
+        free += [ip for ip, _ in results if ip]
+        errors = [e.message for _, e in results if e]
+        if len(free) < count:
+            self.fail_json(
+                msg='Failed to reserve {} of {} IPs'.format(
+                    len(errors), shortfall),
+                msg_details='; '.join(errors), ips=free)
+        return free[:count]
+
+    def next_available(self):
+        """Get the next available IP, or reserve a new one"""
+        return (self.available(1) or [None])[0]
+
+    def forget(self, ip, vm_id=None):
+        """Drop an IP and its VM from the cache, after (dis)connecting"""
+        self.cache.stale('floatingips', ip['id'])
+        if ip.get('port_id'):
+            self.cache.drop('ports', ip['port_id'])
+        vm_id = vm_id or ip.get('instance_id')
+        if vm_id:
+            self.cache.stale('servers', vm_id)
 
     def discover_port(self, port_id):
         if not port_id:
             return None
+        port = self.cache.get('ports', port_id)
+        if port:
+            return port
         try:
-            return self.network.get_port_details(port_id)
+            port = self.network.get_port_details(port_id)
         except ClientError as e:
             self.fail_json(
                 msg='Error while checking for port', msg_details=e.message)
+        self.cache.put('ports', port)
+        return port
 
     # state functions
     def absent(self):
@@ -95,30 +124,35 @@ class SNFPublicIP(AnsibleModule):
         ip = self.discover()
         if ip:
             port_id = ip.get('port_id')
+            if port_id and self.plan(
+                    'detach', 'floatingip', id=ip['id'], port_id=port_id,
+                    floating_ip_address=ip['floating_ip_address']):
+                return dict(changed=True, msg='IP would be disconnected')
             if port_id:
                 try:
                     self.network.delete_port(port_id)
                 except ClientError as e:
                     self.fail_json(
                         msg='Failed to disconnect IP', msg_details=e.message)
-                if self.params.get('wait'):
-                    try:
-                        self.network.wait_port_while(port_id, 'ACTIVE')
-                    except ClientError:
-                        pass
+                self.forget(ip)
+                self.wait_ports([dict(id=port_id)], while_('ACTIVE'))
                 return dict(changed=True, msg='IP disconnected')
             return dict(changed=False, msg="IP not used")
         return dict(changed=False, msg="No such IP")
 
     def present(self):
         """Make sure an IP is present if id or address is given
-           If no id or address is given, find an unused or fresh IP
+           If no id or address is given, find an unused or fresh IP (or
+           "count" of them)
         """
         ip = self.discover()
         if ip:
             return dict(changed=False, ip=ip)
         if self.params.get('address'):
             return dict(changed=True, ip=self.reserve())
+        count = self.params.get('count')
+        if count:
+            return dict(changed=True, ips=self.available(count))
         return dict(changed=True, ip=self.next_available())
 
     def connected(self):
@@ -134,6 +168,9 @@ class SNFPublicIP(AnsibleModule):
             if port['device_id'] == vm_id:
                 return dict(changed=False, port=port)
             return self.fail_json(msg='IP used by another VM')
+        if self.plan('attach', 'floatingip', id=ip['id'], vm_id=vm_id,
+                     floating_ip_address=ip['floating_ip_address']):
+            return dict(changed=True, port=None)
         try:
             port = self.network.create_port(
                 ip['floating_network_id'], vm_id,
@@ -141,11 +178,9 @@ class SNFPublicIP(AnsibleModule):
         except ClientError as e:
             self.fail_json(
                 msg='Failed to connect IP to VM', msg_details=e.message)
-        if self.params.get('wait'):
-            try:
-                port = self.network.wait_port_until(port['id'], 'ACTIVE')
-            except ClientError:
-                pass
+        self.forget(ip, vm_id)
+        self.cache.put('ports', port)
+        port = self.wait_ports([port], until('ACTIVE'))[0]
         return dict(changed=True, port=port)
 
     def disconnected(self):
@@ -159,16 +194,17 @@ class SNFPublicIP(AnsibleModule):
                 if port['device_id'] != vm_id:
                     return dict(
                         changed=False, msg='IP not connected to this VM')
+            if self.plan(
+                    'detach', 'floatingip', id=ip['id'], port_id=port_id,
+                    floating_ip_address=ip['floating_ip_address']):
+                return dict(changed=True, msg='IP would be disconnected')
             try:
                 self.network.delete_port(port_id)
             except ClientError as e:
                 self.fail_json(
                     msg='Failed to disconnect IP', msg_details=e.message)
-            if self.params.get('wait'):
-                try:
-                    self.network.wait_port_while(port_id, 'ACTIVE')
-                except ClientError:
-                    pass
+            self.forget(ip, vm_id)
+            self.wait_ports([dict(id=port_id)], while_('ACTIVE'))
             return dict(changed=True, msg='IP disconnected succesfuly')
         return dict(changed=False, msg='IP not connected')
 
@@ -180,17 +216,27 @@ if __name__ == '__main__':
                 'default': 'present',
                 'choices': ['absent', 'present', 'connected', 'disconnected']},
             'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
             'id': {'required': False, 'type': 'str'},
             'address': {'required': False, 'type': 'str'},
             'vm_id': {'required': False, 'type': 'str'},
+            'count': {'required': False, 'type': 'int'},
+            'pool_size': {'default': 0, 'type': 'int'},
+            'workers': {'default': 10, 'type': 'int'},
+            'facts': {'required': False, 'type': 'dict'},
             'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
         },
-        required_if=(('state', 'connected', ('vm_id', )), )
+        required_if=(('state', 'connected', ('vm_id', )), ),
+        mutually_exclusive=(('count', 'id'), ('count', 'address')),
+        supports_check_mode=True,
     )
-    result = {
+    module.run({
         'absent': module.absent,
         'present': module.present,
         'connected': module.connected,
         'disconnected': module.disconnected,
-    }[module.params['state']]()
-    module.exit_json(**result)
+    }[module.params['state']])
@@ -1,131 +1,199 @@
 #!/usr/bin/python
 # Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
 from kamaki.clients import ClientError
-from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
-from kamaki.clients.network import NetworkClient
-from kamaki.cli import logging
-from kamaki.clients.utils import https
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_catalog import select_flavor, select_image
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_quota import allocate, free, vm_demand
+from ansible.module_utils.snf_wait import until, while_
 
 
-class SNFServer(AnsibleModule):
+class SNFServer(SNFModule):
     """Synnefo server class, based on kamaki
        Create, delete, start, stop, reboot, etc.
     """
-    _compute, _network = None, None
 
-    def __init__(self, *args, **kw):
-        super(SNFServer, self).__init__(*args, **kw)
-        self.cloud = self.params.get('cloud').get('cloud')
+    def setup(self):
         privnet = self.params.get('network')
         self.privnet = privnet.get('network') if privnet else dict()
         ip = self.params.get('public_ip')
         self.ip = ip.get('ip') if ip else dict()
         keypair = self.params.get('keypair')
         self.keypair = keypair.get('keypair') if keypair else dict()
-        ca_certs = self.cloud.get('ca_certs')
-        if ca_certs:
-            try:
-                https.patch_with_certs(ca_certs)
-            except Exception as e:
-                self.fail_json(
-                    msg="Certificates (ca_certs) failed to patch kamaki",
-                    msg_details=e.message)
-        else:
-            https.patch_ignore_ssl()
-
-    # General purpose SNF methods and properties
-    @property
-    def compute(self):
-        if not self._compute:
-            url, token = self.cloud.get('compute_url'), self.cloud.get('token')
-            try:
-                self._compute = CycladesClient(url, token)
-            except ClientError as e:
-                module.fail_json(
-                    msg="Compute Client initialization failed",
-                    msg_details=e.message)
-        return self._compute
-
-    @property
-    def network(self):
-        if not self._network:
-            url, token = self.cloud.get('network_url'), self.cloud.get('token')
-            try:
-                self._network = CycladesNetworkClient(url, token)
-            except ClientError as e:
-                self.fail_json(
-                    msg="Network Client initialization failed",
-                    msg_details=e.message)
-        return self._network
 
     # auxiliary methods
     def discover(self):
         id_, name = self.params.get('id'), self.params.get('name')
         if id_:
+            vm = self.cache.get('servers', id_)
+            if vm:
+                return vm
             try:
-                return self.compute.get_server_details(id_)
+                vm = self.compute.get_server_details(id_)
             except ClientError as e:
                 if e.status in (404, ):
                     return None
                 self.fail_json(
                     msg='Error while looking up VM', msg_details=e.message)
+            self.cache.put('servers', vm)
+            return vm
         try:
-            for vm in self.compute.list_servers(detail=True):
-                if name == vm['name']:
-                    return vm
+            return self.find('servers', name)
+        except ClientError as e:
+            self.fail_json(
+                msg='Error while looking up VM', msg_details=e.message)
+
+    def list_servers(self):
+        """returns: detailed VMs, from the cache if it has a fresh listing"""
+        try:
+            return self.listing('servers')
         except ClientError as e:
             self.fail_json(msg="Could not list VMs", msg_details=e.message)
-        return None
 
-    def discover_ip(self):
-        """Discover the IP with given IP or address"""
+    def remember(self, vm):
+        """Write a new or modified VM through to the cache"""
+        if 'attachments' in vm:
+            self.cache.put('servers', vm)
+        else:
+            self.cache.stale('servers', vm['id'])
+
+    def discover_ip(self, ip=None):
+        """Discover the IP with given IP or address
+           If no ip dict is given, use (and update) the module-level one
+        """
+        if ip is None:
+            ip = self.ip
         required = {'id', 'floating_ip_address', 'floating_network_id'}
-        if not required.difference(self.ip):
-            return self.ip
-        id_, address = self.ip.get('id'), self.ip.get('floating_ip_address')
+        if not required.difference(ip):
+            return ip
+        id_, address = ip.get('id'), ip.get('floating_ip_address')
         if id_:
+            floating_ip = self.cache.get('floatingips', id_)
+            if floating_ip:
+                return floating_ip
             try:
-                return self.network.get_floatingip_details(id_)
+                floating_ip = self.network.get_floatingip_details(id_)
             except ClientError as e:
                 if e.status in (404, ):
                     return None
                 self.fail_json(
                     msg='Error while looking for ip', msg_details=e.message)
+            self.cache.put('floatingips', floating_ip)
+            return floating_ip
         elif address:
-            for ip in self.network.list_floatingips():
-                if address == ip['floating_ip_address']:
-                    self.ip = ip
-                    return self.ip
+            hit, floating_ip = self.cache.lookup(
+                'floatingips', 'floating_ip_address', address)
+            if not hit:
+                floating_ips = self.network.list_floatingips()
+                self.cache.store('floatingips', floating_ips)
+                floating_ip = ([i for i in floating_ips if (
+                    address == i['floating_ip_address'])] or [None])[0]
+            if floating_ip:
+                ip.clear()
+                ip.update(floating_ip)
+                return ip
+        return None
+
+    def resolve(self, kind, item):
+        """Resolve the "flavor" or "image" of a batch item, or of the module,
+           by id (e.g., "flavor_id") or by spec (e.g., "flavor"), against the
+           cached catalog (see snf_catalog)
+           returns: the id, or None if not set
+        """
+        for source in (item, self.params):
+            if source.get(kind + '_id'):
+                return source[kind + '_id']
+            spec = source.get(kind)
+            if spec:
+                try:
+                    records = self.catalog(kind + 's')
+                except ClientError as e:
+                    self.fail_json(
+                        msg='Failed to list {}s'.format(kind),
+                        msg_details=e.message)
+                select = select_flavor if kind == 'flavor' else select_image
+                record = select(records, spec)
+                if not record:
+                    self.fail_json(msg='No {} matches {}'.format(kind, spec))
+                return '{}'.format(record['id'])
         return None
 
-    def create(self):
-        name = self.params.get('name')
-        image_id = self.params.get('image_id')
-        flavor_id = self.params.get('flavor_id')
+    def server_spec(self, item=None):
+        """returns: the create_server arguments for a VM
+           Batch items may override the module parameters, e.g., each VM may
+           have its own "public_ip"
+        """
+        item = item or dict()
 
-        net_id = self.privnet.get('id')
+        def _result(key, result_key, default):
+            value = item.get(key)
+            return (value.get(result_key) or dict()) if value else default
+
+        privnet = _result('network', 'network', self.privnet)
+        ip = _result('public_ip', 'ip', self.ip)
+        keypair = _result('keypair', 'keypair', self.keypair)
+
+        net_id = privnet.get('id')
         networks = [{'uuid': net_id}] if net_id else []
-        ip = self.discover_ip()
+        ip = self.discover_ip(ip)
         if ip:
             networks.append({
                 'uuid': ip['floating_network_id'],
                 'floating_ip_address': ip['floating_ip_address']})
+        spec = dict(
+            name=item.get('name') or self.params.get('name'),
+            image_id=self.resolve('image', item),
+            flavor_id=self.resolve('flavor', item),
+            project_id=self.cloud.get('project_id'),
+            key_name=keypair.get('name'), networks=networks)
+        missing = [k for k in ('image_id', 'flavor_id') if not spec[k]]
+        if missing:
+            self.fail_json(msg='Missing {} for server "{}"'.format(
+                ', '.join(missing), spec['name']))
+        return spec
+
+    def create(self, spec=None):
+        spec = spec or self.server_spec()
+        if self.plan('create', 'server', name=spec['name'], spec=spec):
+            return None
         try:
-            vm = self.compute.create_server(
-                name=name, image_id=image_id, flavor_id=flavor_id,
-                project_id=self.cloud.get('project_id'),
-                key_name=self.keypair.get('name'), networks=networks)
+            vm = self.compute.create_server(**spec)
         except ClientError as e:
             self.fail_json(
                 msg='Failed to create server', msg_details=e.message)
-        if self.params.get('wait'):
-            try:
-                vm = self.compute.wait_server_while(vm['id'], 'BUILD')
-            except ClientError as e:
-                pass
+        vm = self.wait_servers([vm], while_('BUILD'))[0]
+        self.remember(vm)
         return vm
 
+    def batch(self):
+        """returns: a list of server items for batch mode, or None
+           Batch items come either from the "servers" list or from "count"
+           copies of "name", used as a template (e.g., "worker-{index}")
+        """
+        servers, count = self.params.get('servers'), self.params.get('count')
+        if servers:
+            names = [item.get('name') for item in servers]
+            if not all(names):
+                self.fail_json(msg='Every item in "servers" needs a name')
+            if len(set(names)) != len(names):
+                self.fail_json(msg='Server names in "servers" must be unique')
+            return servers
+        if count:
+            name = self.params.get('name')
+            if not name:
+                self.fail_json(msg='A "name" template is required by "count"')
+            if '{index}' not in name:
+                name += '-{index}'
+            return [dict(name=name.format(index=i))
+                    for i in range(1, count + 1)]
+        return None
+
+    def list_by_name(self):
+        """One listing, shared by every VM of a batch"""
+        vms = dict()
+        for vm in self.list_servers():
+            vms.setdefault(vm['name'], vm)
+        return vms
+
     def delete(self, vm_id):
         try:
             self.compute.delete_server(vm_id)
@@ -133,70 +201,211 @@ class SNFServer(AnsibleModule):
             if 'Server has been deleted' not in e.message:
                 self.fail_json(
                     msg="Error deleting VM", msg_details=e.message)
-        if self.params.get('wait'):
-            try:
-                self.compute.wait_server_until(vm_id, 'DELETED')
-            except ClientError as e:
-                pass
+        self.cache.drop('servers', vm_id)
+        self.wait_servers([dict(id=vm_id)], until('DELETED'))
+
+    def _create(self, spec):
+        return self.compute.create_server(**spec)
+
+    def _delete(self, vm):
+        try:
+            self.compute.delete_server(vm['id'])
+        except ClientError as e:
+            if 'Server has been deleted' not in e.message:
+                raise
+        return vm['id']
+
+    def place(self, specs):
+        """Check the VMs to create against the quotas of "projects" (or of
+           the cloud project), before creating any, and split them across
+           the projects in order, so that each project fills up before the
+           next one is used. Sets the project_id of each spec.
+        """
+        projects = self.params.get('projects') or [
+            self.cloud.get('project_id')]
+        if not all(projects):
+            self.fail_json(msg='Set "projects" or a cloud project_id')
+        try:
+            quotas = self.astakos.get_quotas()
+            flavors = {'{}'.format(flavor['id']): flavor for flavor in (
+                self.catalog('flavors'))}
+            demands = {flavor_id: vm_demand(
+                flavors.get('{}'.format(flavor_id)) or (
+                    self.compute.get_flavor_details(flavor_id))) for (
+                        flavor_id) in set(spec['flavor_id'] for spec in specs)}
+        except ClientError as e:
+            self.fail_json(msg='Failed to check quotas', msg_details=e.message)
+        placed = allocate(
+            [demands[spec['flavor_id']] for spec in specs], free(quotas),
+            projects)
+        short = [spec['name'] for spec, p in zip(specs, placed) if not p]
+        if short:
+            available = free(quotas)
+            self.fail_json(
+                msg='Not enough quota for {} of {} servers'.format(
+                    len(short), len(specs)),
+                msg_details='No room for {}'.format(', '.join(short)),
+                quotas={p: available.get(p) for p in projects})
+        for spec, project_id in zip(specs, placed):
+            spec['project_id'] = project_id
+
+    def batch_present(self, items):
+        """Make sure all VMs in the batch exist, create the missing ones
+           concurrently, once they fit in the quotas, if checked
+        """
+        existing = self.list_by_name()
+        missing = [self.server_spec(item) for item in items if (
+            item['name'] not in existing)]
+        if missing and (
+                self.params.get('check_quota') or self.params.get('projects')):
+            self.place(missing)
+        if self.check_mode:
+            for spec in missing:
+                self.plan('create', 'server', name=spec['name'], spec=spec)
+            return dict(changed=bool(missing), servers=[
+                existing.get(item['name']) for item in items])
+        results = self.run_parallel(
+            self._create, missing)
+        vms = self.wait_servers(
+            [vm for vm, _ in results if vm], while_('BUILD'))
+        created = {vm['name']: vm for vm in vms}
+        for vm in vms:
+            self.remember(vm)
+        errors = ['{}: {}'.format(spec['name'], e.message) for spec, (
+            vm, e) in zip(missing, results) if e]
+        servers = [existing.get(item['name']) or created.get(item['name'])
+                   for item in items]
+        if errors:
+            self.fail_json(
+                msg='Failed to create {} of {} servers'.format(
+                    len(errors), len(missing)),
+                msg_details='; '.join(errors),
+                servers=[vm for vm in servers if vm])
+        return dict(changed=bool(created), servers=servers)
+
+    def batch_absent(self, items):
+        """Make sure none of the VMs in the batch exist, delete concurrently"""
+        existing = self.list_by_name()
+        vms = [existing[item['name']] for item in items if (
+            item['name'] in existing)]
+        if self.check_mode:
+            for vm in vms:
+                self.plan('delete', 'server', id=vm['id'], name=vm['name'])
+            return dict(
+                changed=bool(vms), msg='{} VMs to delete'.format(len(vms)),
+                deleted=[vm['id'] for vm in vms])
+        results = self.run_parallel(
+            self._delete, vms)
+        errors = ['{}: {}'.format(vm['name'], e.message) for vm, (
+            _, e) in zip(vms, results) if e]
+        deleted = [vm for vm, (id_, _) in zip(vms, results) if id_]
+        for vm in deleted:
+            self.cache.drop('servers', vm['id'])
+        self.wait_servers(deleted, until('DELETED'))
+        if errors:
+            self.fail_json(
+                msg='Failed to delete {} of {} servers'.format(
+                    len(errors), len(vms)),
+                msg_details='; '.join(errors))
+        return dict(
+            changed=bool(vms), msg='{} VMs deleted'.format(len(vms)),
+            deleted=[vm['id'] for vm in vms])
+
+    def diff(self, vm):
+        """returns: the changes an existing VM needs, e.g.,
+           [{'action': 'rename', 'new_name': ...},
+            {'action': 'attach', 'network_id': ...}]
+        """
+        changes, name = [], self.params['name']
+        if name and name != vm['name']:
+            changes.append(dict(action='rename', new_name=name))
+        net_id = self.privnet.get('id')
+        if net_id and net_id not in vm['addresses']:
+            changes.append(dict(action='attach', network_id=net_id))
+        ip = self.discover_ip()
+        ip4s = [att['ipv4'] for att in vm['attachments'] if att['ipv4']]
+        if ip and ip['floating_ip_address'] not in ip4s:
+            changes.append(dict(
+                action='attach', network_id=ip['floating_network_id'],
+                floating_ip_address=ip['floating_ip_address'],
+                floating_ip_id=ip['id']))
+        return changes
+
+    def _apply(self, vm, change):
+        """Make a change, e.g., in a worker thread
+           returns: the new port, for attachments
+        """
+        if change['action'] == 'rename':
+            self.compute.update_server_name(vm['id'], change['new_name'])
+            return None
+        address = change.get('floating_ip_address')
+        return self.network.create_port(
+            change['network_id'], vm['id'],
+            fixed_ips=[{'ip_address': address}] if address else None)
+
+    def reconcile(self, vm):
+        """Make all the changes of an existing VM concurrently and wait for
+           all new ports together
+           returns: True if anything changed
+        """
+        changes = self.diff(vm)
+        if self.check_mode:
+            for change in changes:
+                details = dict(change)
+                self.plan(
+                    details.pop('action'), 'server', id=vm['id'],
+                    name=vm['name'], **details)
+            return bool(changes)
+        results = self.run_parallel(
+            lambda change: self._apply(vm, change), changes)
+        ports = []
+        for change, (port, e) in zip(changes, results):
+            if e:
+                continue
+            if change['action'] == 'rename':
+                vm['name'] = change['new_name']
+                continue
+            ports.append(port)
+            self.cache.put('ports', port)
+            if change.get('floating_ip_id'):
+                self.cache.stale('floatingips', change['floating_ip_id'])
+        if ports:
+            self.cache.stale('servers', vm['id'])
+        elif changes:
+            self.remember(vm)
+        self.wait_ports(ports, until('ACTIVE'))
+        errors = ['{action}: {}'.format(e.message, **change) for change, (
+            _, e) in zip(changes, results) if e]
+        if errors:
+            self.fail_json(
+                msg='Failed to update {} of {} server features'.format(
+                    len(errors), len(changes)),
+                msg_details='; '.join(errors), server=vm)
+        return bool(changes)
 
     # Functions
     def present(self):
         """Make sure a VM with given features exist
            Create it, if not exist, modify what is modifiable otherwise
         """
-        vm, changed = self.discover(), False
+        items = self.batch()
+        if items is not None:
+            return self.batch_present(items)
+        vm = self.discover()
         if not vm:
-            vm = self.create()
-            changed = True
-        else:
-            name = self.params['name']
-            if name and name != vm['name']:
-                try:
-                    self.compute.update_server_name(vm['id'], name)
-                    changed = True
-                except ClientError as e:
-                    self.fail_json(
-                        msg='Failed to changed server name',
-                        msg_details=e.message)
-
-            net_id = self.privnet.get('id')
-            if net_id and net_id not in vm['addresses']:
-                try:
-                    port = self.network.create_port(net_id, vm['id'])
-                except ClientError as e:
-                    self.fail_json(
-                        msg='Failed to connect server to network',
-                        msg_details=e.message)
-                changed = True
-                if self.params.get('wait'):
-                    try:
-                        self.network.wait_port_until(port['id'], 'ACTIVE')
-                    except ClientError:
-                        pass
-
-            ip = self.discover_ip()
-            ip4s = [att['ipv4'] for att in vm['attachments'] if att['ipv4']]
-            if ip and ip['floating_ip_address'] not in ip4s:
-                try:
-                    port = self.network.create_port(
-                        ip['floating_network_id'], vm['id'],
-                        fixed_ips=[{'ip_address': ip['floating_ip_address']}])
-                except ClientError as e:
-                    self.fail_json(
-                        msg='Failed to attach IP to server',
-                        msg_details=e.message)
-                if self.params.get('wait'):
-                    try:
-                        self.network.wait_port_until(port['id'], 'ACTIVE')
-                    except ClientError:
-                        pass
-        return dict(changed=changed, server=vm)
+            return dict(changed=True, server=self.create())
+        return dict(changed=self.reconcile(vm), server=vm)
 
     def absent(self):
         """Make sure VM is not there (e.g., delete it)"""
+        items = self.batch()
+        if items is not None:
+            return self.batch_absent(items)
         vm = self.discover()
         if not vm:
             return dict(changed=False, msg='VM not found')
+        if self.plan('delete', 'server', id=vm['id'], name=vm['name']):
+            return dict(changed=True, msg='VM would be deleted')
         self.delete(vm['id'])
         return dict(changed=True, msg='VM is now deleted')
 
@@ -206,16 +415,17 @@ class SNFServer(AnsibleModule):
             self.fail_json(msg='Cannot find VM to start')
         if vm['status'] == 'ACTIVE':
             return dict(changed=False, server=vm)
+        if self.plan('start', 'server', id=vm['id'], name=vm['name']):
+            return dict(changed=True, server=vm)
         try:
             self.compute.start_server(vm['id'])
         except ClientError as e:
             self.fail_json(msg="Failed to start VM", msg_details=e.message)
             return
-        if self.params['wait']:
-            try:
-                vm = self.compute.wait_server_until(vm['id'], 'ACTIVE')
-            except ClientError:
-                pass
+        self.cache.stale('servers', vm['id'])
+        vm = self.wait_servers([vm], until('ACTIVE'))[0]
+        if vm['status'] == 'ACTIVE':
+            self.remember(vm)
         return dict(changed=True, server=vm)
 
     def stopped(self):
@@ -224,16 +434,17 @@ class SNFServer(AnsibleModule):
             self.fail_json(msg='Cannot find VM to stop')
         if vm['status'] == 'STOPPED':
             return dict(changed=False, server=vm)
+        if self.plan('stop', 'server', id=vm['id'], name=vm['name']):
+            return dict(changed=True, server=vm)
         try:
             self.compute.shutdown_server(vm['id'])
         except ClientError as e:
             self.fail_json(msg="Failed to stop VM", msg_details=e.message)
             return
-        if self.params['wait']:
-            try:
-                vm = self.compute.wait_server_until(vm['id'], 'STOPPED')
-            except ClientError:
-                pass
+        self.cache.stale('servers', vm['id'])
+        vm = self.wait_servers([vm], until('STOPPED'))[0]
+        if vm['status'] == 'STOPPED':
+            self.remember(vm)
         return dict(changed=True, server=vm)
 
 
@@ -244,23 +455,39 @@ if __name__ == '__main__':
                 'default': 'present',
                 'choices': ['present', 'absent', 'stopped', 'active']},
             'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
             'id': {'required': False, 'type': 'str'},
             'name': {'required': False, 'type': 'str'},
             'image_id': {'required': False, 'type': 'str'},
             'flavor_id': {'required': False, 'type': 'str'},
+            'image': {'required': False, 'type': 'dict'},
+            'flavor': {'required': False, 'type': 'dict'},
             'keypair': {'required': False, 'type': 'dict'},
             'network': {'required': False, 'type': 'dict'},
             'public_ip': {'required': False, 'type': 'dict'},
+            'facts': {'required': False, 'type': 'dict'},
             'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'servers': {'required': False, 'type': 'list'},
+            'count': {'required': False, 'type': 'int'},
+            'check_quota': {'default': False, 'type': 'bool'},
+            'projects': {'required': False, 'type': 'list'},
+            'workers': {'default': 10, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
         },
         required_if=(
-            ('state', 'present', ['name', 'image_id', 'flavor_id', ]),
+            ('state', 'present', ['name', 'servers'], True),
         ),
+        mutually_exclusive=(
+            ('servers', 'count'), ('id', 'servers'), ('flavor', 'flavor_id'),
+            ('image', 'image_id')),
+        supports_check_mode=True,
     )
-    result = {
+    module.run({
         'absent': module.absent,
         'present': module.present,
         'stopped': module.stopped,
         'active': module.active,
-    }[module.params['state']]()
-    module.exit_json(**result)
+    }[module.params['state']])
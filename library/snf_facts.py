@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_cache import snapshot_index
+
+KINDS = ('servers', 'networks', 'ports', 'floatingips', 'keypairs')
+
+
+class SNFFacts(SNFModule):
+    """Synnefo facts class, based on kamaki
+       Snapshot all the resources of a cloud with one listing per type, to be
+       passed to other modules as "facts"
+    """
+
+    # State functions
+    def present(self):
+        """List all resource types concurrently, servers as changes since
+           the last snapshot, if cached
+           returns: {kind: {'ids': {id: record}, <field>: {value: id}}}
+        """
+        kinds = self.params.get('kinds') or KINDS
+        results = self.run_parallel(
+            lambda kind: self.listing(kind, fresh=True), kinds)
+        errors = ['{}: {}'.format(kind, e.message) for kind, (
+            _, e) in zip(kinds, results) if e]
+        if errors:
+            self.fail_json(
+                msg='Failed to list {}'.format(', '.join(
+                    kind for kind, (_, e) in zip(kinds, results) if e)),
+                msg_details='\n'.join(errors))
+        facts = dict()
+        for kind, (records, _) in zip(kinds, results):
+            facts[kind] = snapshot_index(kind, records)
+        return dict(changed=False, facts=facts)
+
+
+if __name__ == '__main__':
+    module = SNFFacts(
+        argument_spec={
+            'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
+            'kinds': {'required': False, 'type': 'list', 'choices': KINDS},
+            'workers': {'default': 5, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        supports_check_mode=True,
+    )
+    module.run(module.present)
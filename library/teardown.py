@@ -0,0 +1,227 @@
+#!/usr/bin/python
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import re
+from kamaki.clients import ClientError
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_wait import until, while_
+
+# Names of keypairs generated by the keypair module (see keypair.key_name)
+AUTOGEN_PREFIX = 'ansible-autogen_'
+
+
+def brief(kind, record):
+    """returns: the identifying fields of a record, for reports and plans"""
+    fields = {
+        'server': ('id', 'name'),
+        'port': ('id', 'network_id', 'device_id'),
+        'floatingip': ('id', 'floating_ip_address'),
+        'network': ('id', 'name'),
+        'keypair': ('name', ),
+    }[kind]
+    return {field: record.get(field) for field in fields}
+
+
+class SNFTeardown(SNFModule):
+    """Synnefo teardown class, based on kamaki
+       Delete the resources matching a selector in dependency order: VMs,
+       then their ports and floating IPs, then networks. Deletions of the
+       same type run concurrently. Report (or delete) the orphans the
+       deleted VMs left behind.
+    """
+
+    def __init__(self, *args, **kw):
+        super(SNFTeardown, self).__init__(*args, **kw)
+        regex = self.params.get('regex')
+        try:
+            self.regex = re.compile(regex) if regex else None
+        except re.error as e:
+            self.fail_json(msg='Invalid regex', msg_details='{}'.format(e))
+        self.errors = []
+
+    def selected(self, name, metadata=None):
+        """Names must match both prefix and regex, VM metadata must contain
+           all the selector metadata. Networks have no metadata, so they are
+           selected by name only.
+           returns: True if a resource matches the selector
+        """
+        prefix, meta = self.params.get('prefix'), self.params.get('metadata')
+        name = name or ''
+        if metadata is None and not (prefix or self.regex):
+            return False
+        if metadata is not None and not (prefix or self.regex or meta):
+            return False
+        return all((
+            not prefix or name.startswith(prefix),
+            not self.regex or self.regex.search(name),
+            metadata is None or all(
+                '{}'.format(metadata.get(k)) == '{}'.format(v) for k, v in (
+                    (meta or dict()).items()))))
+
+    def list_(self, kind, fresh=False):
+        """returns: the resources of the project, listed at most once"""
+        try:
+            records = self.listing(kind, fresh)
+        except ClientError as e:
+            self.fail_json(
+                msg='Failed to list {}'.format(kind), msg_details=e.message)
+        project = self.cloud.get('project_id')
+        return [r for r in records if not (
+            project and r.get('tenant_id', project) != project)]
+
+    def _ignore_missing(self, func):
+        def _delete(id_):
+            try:
+                func(id_)
+            except ClientError as e:
+                if not (e.status in (404, ) or (
+                        'has been deleted' in e.message)):
+                    raise
+        return _delete
+
+    def delete_all(self, kind, records, func, key='id'):
+        """Delete records concurrently, keep the errors
+           returns: the deleted records (the planned ones, in check mode)
+        """
+        if self.check_mode:
+            for record in records:
+                self.plan(
+                    'detach' if kind == 'port' else 'delete', kind,
+                    **brief(kind, record))
+            return records
+        results = self.run_parallel(
+            self._ignore_missing(func), [r[key] for r in records])
+        self.errors += ['{} {}: {}'.format(kind, r[key], e.message) for r, (
+            _, e) in zip(records, results) if e]
+        deleted = [r for r, (_, e) in zip(records, results) if not e]
+        cache_kind = kind + 's'
+        for record in deleted:
+            self.cache.drop(cache_kind, record[key])
+        return deleted
+
+    def orphans(self, vms, servers, ports, ips, networks, touched):
+        """Resources the deleted VMs left behind, besides the ones to delete:
+           on the networks they were connected to (touched), ports of missing
+           VMs and private networks without ports, and the generated keypairs
+           of the deleted VMs no other VM uses. Free floating IPs may be kept
+           in reserve, so they are orphans only with "free_ips".
+           returns: {kind: [records]}
+        """
+        vm_ids = {'{}'.format(vm['id']) for vm in servers}
+        orphan_ports = [p for p in ports if (
+            '{}'.format(p['network_id']) in touched) and (
+                '{}'.format(p['device_id']) not in vm_ids)]
+        busy = {'{}'.format(p['network_id']) for p in ports if (
+            p not in orphan_ports)}
+        key_names = {vm.get('key_name') for vm in vms if (
+            vm.get('key_name') or '').startswith(AUTOGEN_PREFIX)}.difference(
+                vm.get('key_name') for vm in servers)
+        return dict(
+            ports=orphan_ports,
+            floatingips=[ip for ip in ips if not ip['port_id'] and (
+                self.params.get('free_ips'))],
+            networks=[net for net in networks if (
+                '{}'.format(net['id']) in touched) and (
+                    net.get('type') == 'MAC_FILTERED' and (
+                        not net.get('public')) and (
+                            '{}'.format(net['id']) not in busy))],
+            keypairs=[k for k in self.list_('keypairs') if (
+                k['name'] in key_names)] if key_names else [])
+
+    # State functions
+    def absent(self):
+        """Delete the selected VMs and wait for them, then their ports and
+           the ports of the selected networks, then their floating IPs, then
+           the selected networks
+        """
+        # IPs are listed before their VMs go, to know which VMs had them
+        servers, ips = self.list_('servers'), self.list_('floatingips')
+        vms = [vm for vm in servers if self.selected(
+            vm['name'], vm.get('metadata') or dict())]
+        vms = self.delete_all(
+            'server', vms, lambda id_: self.compute.delete_server(id_))
+        self.wait_servers(vms, until('DELETED'))
+        gone = {'{}'.format(vm['id']) for vm in vms}
+        servers = [vm for vm in servers if '{}'.format(vm['id']) not in gone]
+
+        networks = self.list_('networks')
+        nets = [net for net in networks if self.selected(net['name']) and (
+            not net.get('public'))]
+        net_ids = {'{}'.format(net['id']) for net in nets}
+        fresh = bool(vms) and self.params.get('wait') and not self.check_mode
+        ports = self.list_('ports', fresh)
+        doomed = [p for p in ports if '{}'.format(p['device_id']) in gone or (
+            '{}'.format(p['network_id']) in net_ids)]
+        port_ids = {p['id'] for p in doomed}
+        touched = {'{}'.format(a['network_id']) for vm in vms for a in (
+            vm.get('attachments') or [])}.union(
+                '{}'.format(p['network_id']) for p in doomed if (
+                    '{}'.format(p['device_id']) in gone)).difference(net_ids)
+        released = [ip for ip in ips if self.params.get('release_ips') and (
+            '{}'.format(ip.get('instance_id')) in gone or (
+                ip['port_id'] and ip['port_id'] in port_ids))]
+        orphans = self.orphans(
+            vms, servers, [p for p in ports if p['id'] not in port_ids],
+            [dict(ip, port_id=None) if (
+                '{}'.format(ip.get('instance_id')) in gone or (
+                    ip['port_id'] in port_ids)) else ip for ip in ips if (
+                ip not in released)],
+            [net for net in networks if net not in nets], touched)
+        keypairs = []
+        if self.params.get('orphans') == 'delete':
+            doomed += orphans['ports']
+            released += orphans['floatingips']
+            nets += orphans['networks']
+            keypairs = orphans['keypairs']
+
+        # Clients are per thread, so workers must get them from self
+        doomed = self.delete_all(
+            'port', doomed, lambda id_: self.network.delete_port(id_))
+        self.wait_ports(doomed, while_('ACTIVE'))
+        released = self.delete_all(
+            'floatingip', released,
+            lambda id_: self.network.delete_floatingip(id_))
+        nets = self.delete_all(
+            'network', nets, lambda id_: self.network.delete_network(id_))
+        keypairs = self.delete_all(
+            'keypair', keypairs,
+            lambda name: self.compute.delete_keypair(name), key='name')
+
+        deleted = dict(
+            servers=vms, ports=doomed, floatingips=released, networks=nets,
+            keypairs=keypairs)
+        result = dict(
+            changed=any(deleted.values()),
+            deleted={kind: [brief(kind[:-1], r) for r in records] for (
+                kind, records) in deleted.items()},
+            orphans={kind: [brief(kind[:-1], r) for r in records] for (
+                kind, records) in orphans.items()})
+        if self.errors:
+            self.fail_json(
+                msg='Failed to delete {} resources'.format(len(self.errors)),
+                msg_details='; '.join(self.errors), **result)
+        return result
+
+
+if __name__ == '__main__':
+    module = SNFTeardown(
+        argument_spec={
+            'state': {'default': 'absent', 'choices': ['absent']},
+            'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
+            'prefix': {'required': False, 'type': 'str'},
+            'regex': {'required': False, 'type': 'str'},
+            'metadata': {'required': False, 'type': 'dict'},
+            'release_ips': {'default': True, 'type': 'bool'},
+            'orphans': {'default': 'report', 'choices': ['report', 'delete']},
+            'free_ips': {'default': False, 'type': 'bool'},
+            'workers': {'default': 10, 'type': 'int'},
+            'facts': {'required': False, 'type': 'dict'},
+            'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        supports_check_mode=True,
+    )
+    module.run(module.absent)
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from threading import Lock
+from ansible.module_utils.snf_common import (
+    SNFModule, key_fingerprint, with_fingerprint)
+from ansible.module_utils.snf_graph import Graph, DependencyFailed
+from ansible.module_utils.snf_wait import until, while_
+
+# Resource type: (cache kind, lookup field)
+TYPES = {
+    'keypair': ('keypairs', 'name'),
+    'network': ('networks', 'name'),
+    'public_ip': ('floatingips', 'floating_ip_address'),
+    'server': ('servers', 'name'),
+}
+
+
+class SNFTopology(SNFModule):
+    """Synnefo topology class, based on kamaki
+       Make sure a whole set of keypairs, networks, public IPs and servers
+       exists. Every resource is a node of a dependency graph (a server
+       depends on its keypair, networks and IP, every resource on the listing
+       of its type) and independent nodes are reconciled concurrently.
+       In check mode, the missing resources are planned from the listings.
+    """
+
+    def __init__(self, *args, **kw):
+        super(SNFTopology, self).__init__(*args, **kw)
+        # Nodes that created something, appended by worker threads
+        self.changed, self._lock, self._claimed = [], Lock(), set()
+        self.specs = dict()
+        for type_, key in (
+                ('keypair', 'keypairs'), ('network', 'networks'),
+                ('public_ip', 'public_ips'), ('server', 'servers')):
+            for spec in self.params.get(key) or []:
+                if not spec.get('name'):
+                    self.fail_json(
+                        msg='Every item in "{}" needs a name'.format(key))
+                if (type_, spec['name']) in self.specs:
+                    self.fail_json(msg='Duplicate {} "{}"'.format(
+                        type_, spec['name']))
+                self.specs[(type_, spec['name'])] = spec
+
+    def graph(self):
+        graph = Graph()
+        for (type_, name), spec in self.specs.items():
+            deps = [('list', TYPES[type_][0])]
+            if type_ == 'public_ip':
+                # An IP already attached to its server is reused
+                deps.append(('list', 'servers'))
+            if type_ == 'server':
+                if spec.get('keypair'):
+                    deps.append(('keypair', spec['keypair']))
+                deps += [('network', n) for n in spec.get('networks') or []]
+                if spec.get('public_ip'):
+                    deps.append(('public_ip', spec['public_ip']))
+                missing = [d for d in deps[1:] if d not in self.specs]
+                if missing:
+                    self.fail_json(
+                        msg='Server "{}" needs undeclared {}'.format(
+                            name, ', '.join(
+                                '{} "{}"'.format(*d) for d in missing)))
+            for dep in deps:
+                graph.add(dep)
+            graph.add((type_, name), deps)
+        return graph
+
+    # Nodes, run by worker threads: must raise, not fail_json
+    def _list(self, kind):
+        records = self.listing(kind)
+        field = TYPES[[t for t, (k, _) in TYPES.items() if k == kind][0]][1]
+        index = dict()
+        for record in records:
+            index.setdefault(record.get(field), record)
+        return dict(records=records, index=index)
+
+    def _keypair(self, spec, listing):
+        pair = listing['index'].get(spec['name'])
+        if pair:
+            return pair
+        if self.plan('create', 'keypair', name=spec['name'],
+                     fingerprint=key_fingerprint(spec.get('public_key'))):
+            return dict(name=spec['name'])
+        pair = self.compute.create_key(
+            key_name=spec['name'], public_key=spec.get('public_key'))
+        self.changed.append(('keypair', spec['name']))
+        self.cache.put('keypairs', with_fingerprint(pair))
+        return pair
+
+    def _network(self, spec, listing):
+        net = listing['index'].get(spec['name'])
+        if not net and self.plan('create', 'network', name=spec['name']):
+            net = dict(id=None, name=spec['name'], subnets=[])
+        elif not net:
+            net = self.network.create_network(
+                type='MAC_FILTERED', name=spec['name'],
+                project_id=self.cloud.get('project_id'))
+            self.changed.append(('network', spec['name']))
+        if spec.get('cidr') and not net['subnets'] and self.plan(
+                'create', 'subnet', network_id=net['id'], name=net['name'],
+                cidr=spec['cidr']):
+            return net
+        elif spec.get('cidr') and not net['subnets']:
+            subnet = self.network.create_subnet(
+                net['id'], spec['cidr'], enable_dhcp=spec.get('dhcp'))
+            net['subnets'].append(subnet['id'])
+            self.changed.append(('network', spec['name']))
+        if net['id']:
+            self.cache.put('networks', net)
+        return net
+
+    def _public_ip(self, spec, listing, servers):
+        address = spec.get('address')
+        vm_ids = [servers['index'][s['name']]['id'] for (type_, _), s in (
+            self.specs.items()) if type_ == 'server' and (
+                s.get('public_ip') == spec['name'] and (
+                    s['name'] in servers['index']))]
+        with self._lock:
+            if address:
+                ip = listing['index'].get(address)
+            else:
+                ip = ([i for i in listing['records'] if (
+                    i.get('instance_id') in vm_ids)] or [None])[0]
+            if not (ip or address):
+                ip = ([i for i in listing['records'] if not (
+                    i['port_id'] or i['id'] in self._claimed)] or [None])[0]
+            if ip:
+                self._claimed.add(ip['id'])
+                return ip
+        if self.plan('create', 'floatingip', floating_ip_address=address):
+            return dict(
+                id=None, floating_ip_address=address, port_id=None,
+                floating_network_id=None)
+        ip = self.network.create_floatingip(
+            floating_ip_address=address,
+            project_id=self.cloud.get('project_id'))
+        self.changed.append(('public_ip', spec['name']))
+        self.cache.put('floatingips', ip)
+        return ip
+
+    def _server(self, spec, listing, inputs):
+        nets = [inputs[('network', n)] for n in spec.get('networks') or []]
+        ip = inputs.get(('public_ip', spec.get('public_ip')))
+        vm = listing['index'].get(spec['name'])
+        if not vm:
+            networks = [{'uuid': net['id']} for net in nets]
+            if ip:
+                networks.append({
+                    'uuid': ip['floating_network_id'],
+                    'floating_ip_address': ip['floating_ip_address']})
+            pair = inputs.get(('keypair', spec.get('keypair'))) or dict()
+            server = dict(
+                name=spec['name'], image_id=spec['image_id'],
+                flavor_id=spec['flavor_id'], key_name=pair.get('name'),
+                project_id=self.cloud.get('project_id'), networks=networks)
+            if self.plan('create', 'server', name=spec['name'], spec=server):
+                return dict(vm=None)
+            return dict(vm=self.compute.create_server(**server))
+        ports, attached = [], [a['network_id'] for a in vm['attachments']]
+        for net in nets:
+            if net['id'] not in attached and not self.plan(
+                    'attach', 'network', id=net['id'], name=net['name'],
+                    vm_id=vm['id']):
+                ports.append(self.network.create_port(net['id'], vm['id']))
+        ip4s = [a['ipv4'] for a in vm['attachments'] if a['ipv4']]
+        if ip and ip['floating_ip_address'] not in ip4s and not self.plan(
+                'attach', 'floatingip', id=ip['id'], vm_id=vm['id'],
+                floating_ip_address=ip['floating_ip_address']):
+            ports.append(self.network.create_port(
+                ip['floating_network_id'], vm['id'],
+                fixed_ips=[{'ip_address': ip['floating_ip_address']}]))
+        if ports:
+            self.cache.stale('servers', vm['id'])
+        return dict(vm=vm, ports=ports)
+
+    def _node(self, node, inputs):
+        type_, name = node
+        if type_ == 'list':
+            return self._list(name)
+        spec, listing = self.specs[node], inputs[('list', TYPES[type_][0])]
+        if type_ == 'server':
+            return self._server(spec, listing, inputs)
+        if type_ == 'public_ip':
+            return self._public_ip(spec, listing, inputs[('list', 'servers')])
+        return getattr(self, '_' + type_)(spec, listing)
+
+    # State functions
+    def present(self):
+        graph = self.graph()
+        # Nodes run on worker threads, which must not fail_json: set up the
+        # transport and the clients (e.g., their urls) on this thread first
+        self.compute, self.network
+        results = graph.run(self._node, self.params.get('workers'))
+        errors = []
+        for node, (_, e) in sorted(results.items()):
+            if isinstance(e, DependencyFailed):
+                e.message = 'skipped, depends on failed {}'.format(', '.join(
+                    '{} "{}"'.format(*n) for n in sorted(e.failed)))
+            if e:
+                errors.append('{} "{}": {}'.format(
+                    node[0], node[1], getattr(e, 'message', e)))
+        created = [r['vm'] for (type_, _), (r, _) in results.items() if (
+            type_ == 'server' and r and r['vm'] and 'ports' not in r)]
+        ports = sum([r['ports'] for (type_, _), (r, _) in results.items() if (
+            type_ == 'server' and r and 'ports' in r)], [])
+        vms = {vm['id']: vm for vm in self.wait_servers(
+            created, while_('BUILD'))}
+        for vm in vms.values():
+            self.cache.put('servers', vm)
+        self.wait_ports(ports, until('ACTIVE'))
+
+        topology, start = dict(), min(
+            [t[0] for t in graph.timings.values()] or [0])
+        for (type_, name), (result, _) in results.items():
+            if type_ == 'list' or not result:
+                continue
+            if type_ == 'server':
+                result = result['vm'] and vms.get(
+                    result['vm']['id'], result['vm'])
+            topology.setdefault(type_ + 's', dict())[name] = result
+        seconds, path = graph.critical_path()
+        schedule = dict(
+            critical_path=['{}:{}'.format(*node) for node in path],
+            critical_path_seconds=round(seconds, 2),
+            seconds=round(max(
+                [t[1] for t in graph.timings.values()] or [start]) - start, 2),
+            steps_seconds=round(sum(
+                end - begin for begin, end in graph.timings.values()), 2))
+        changed = bool(self.changed or created or ports or self.changes)
+        if errors:
+            self.fail_json(
+                msg='Failed to reconcile {} resources'.format(len(errors)),
+                msg_details='; '.join(errors), schedule=schedule, **topology)
+        return dict(changed=changed, schedule=schedule, **topology)
+
+
+if __name__ == '__main__':
+    module = SNFTopology(
+        argument_spec={
+            'state': {'default': 'present', 'choices': ['present']},
+            'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
+            'keypairs': {'required': False, 'type': 'list'},
+            'networks': {'required': False, 'type': 'list'},
+            'public_ips': {'required': False, 'type': 'list'},
+            'servers': {'required': False, 'type': 'list'},
+            'workers': {'default': 10, 'type': 'int'},
+            'facts': {'required': False, 'type': 'dict'},
+            'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        supports_check_mode=True,
+    )
+    module.run(module.present)
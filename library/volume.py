@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from kamaki.clients import ClientError
+from kamaki.clients.cyclades import CycladesBlockStorageClient
+from ansible.module_utils.snf_common import SNFModule
+from ansible.module_utils.snf_wait import volume_waiter
+
+# Volume statuses to wait on (Cyclades reports them in lower case)
+BUSY = ('creating', 'attaching', 'detaching', 'deleting')
+
+
+def status(volume):
+    """returns: the status of a volume, "deleted" if it is missing"""
+    return (volume or dict(status='deleted'))['status'].lower()
+
+
+def settled(volume):
+    return status(volume) not in BUSY
+
+
+def gone(volume):
+    return status(volume) in ('deleted', 'error')
+
+
+def attached_to(volume):
+    """returns: the ids of the VMs a volume is attached to"""
+    return ['{}'.format(a['server_id']) for a in (
+        volume.get('attachments') or [])]
+
+
+class SNFVolume(SNFModule):
+    """Synnefo volume class, based on kamaki
+       Create, attach and delete data volumes. Volumes are created attached
+       to their VM. With "servers", every VM of a fleet gets its volume: they
+       are listed once, created concurrently and waited on together.
+    """
+    _volumes = None
+
+    def setup(self):
+        try:
+            url = self.cloud.get('volume_url') or self.endpoint('volume')
+        except ClientError as e:
+            self.fail_json(msg='Failed to authenticate', msg_details=e.message)
+        if not url:
+            self.fail_json(msg='No volume endpoint in the cloud')
+        self.cloud = dict(self.cloud, volume_url=url)
+
+    @property
+    def volume(self):
+        return self._client(
+            'volume', CycladesBlockStorageClient, 'volume_url')
+
+    def list_volumes(self):
+        """returns: detailed volumes, listed at most once per run"""
+        if self._volumes is None:
+            try:
+                self._volumes = self.volume.list_volumes(detail=True)
+            except ClientError as e:
+                self.fail_json(
+                    msg='Could not list volumes', msg_details=e.message)
+        return self._volumes
+
+    def server_ids(self):
+        """returns: the ids of the VMs of "servers" (VM records, e.g., from
+           a server batch, or ids), or of "server_id"
+        """
+        servers = self.params.get('servers')
+        if servers is None:
+            server_id = self.params.get('server_id')
+            return [server_id] if server_id else []
+        return ['{}'.format(vm['id'] if isinstance(vm, dict) else vm) for (
+            vm) in servers if vm]
+
+    def by_server(self):
+        """returns: {VM id: the volume named "name" attached to it}"""
+        name, volumes = self.params.get('name'), dict()
+        for volume in self.list_volumes():
+            if name == (volume.get('display_name') or volume.get('name')) and (
+                    status(volume) != 'deleted'):
+                for server_id in attached_to(volume):
+                    volumes.setdefault(server_id, volume)
+        return volumes
+
+    def discover(self):
+        """returns: the volume with the given id, or None"""
+        try:
+            return self.volume.get_volume_details(self.params.get('id'))
+        except ClientError as e:
+            if e.status in (404, ):
+                return None
+            self.fail_json(
+                msg='Error while looking up volume', msg_details=e.message)
+
+    def volume_spec(self, server_id):
+        """returns: the create_volume arguments for the volume of a VM"""
+        return dict(
+            size=self.params.get('size'), server_id=server_id,
+            display_name=self.params.get('name'),
+            volume_type=self.params.get('volume_type'),
+            project=self.cloud.get('project_id'))
+
+    def _create(self, spec):
+        return self.volume.create_volume(**spec)
+
+    def _delete(self, volume):
+        try:
+            self.volume.delete_volume(volume['id'])
+        except ClientError as e:
+            if e.status not in (404, ):
+                raise
+        return volume['id']
+
+    def wait_volumes(self, volumes, stop):
+        waiter = volume_waiter(self.volume, self.params.get('wait_timeout'))
+        return self.wait_for(waiter, volumes, stop)
+
+    def result(self, changed, volumes):
+        """One "volume" for "server_id", a list of "volumes" for "servers"
+        """
+        if self.params.get('servers') is None:
+            return dict(changed=changed, volume=volumes[0] if (
+                volumes) else None)
+        return dict(changed=changed, volumes=volumes)
+
+    # State functions
+    def present(self):
+        """Make sure every VM has a volume named "name", create the missing
+           ones concurrently and wait on them together
+        """
+        server_ids = self.server_ids()
+        if not server_ids:
+            self.fail_json(msg='Volumes need a "server_id" or "servers"')
+        existing = self.by_server()
+        specs = [self.volume_spec(server_id) for server_id in server_ids if (
+            server_id not in existing)]
+        if self.check_mode:
+            for spec in specs:
+                self.plan(
+                    'create', 'volume', name=spec['display_name'], spec=spec)
+            return self.result(bool(specs), [
+                existing.get(server_id) for server_id in server_ids])
+        results = self.run_parallel(self._create, specs)
+        volumes = self.wait_volumes(
+            [volume for volume, _ in results if volume], settled)
+        waited = {'{}'.format(volume['id']): volume for volume in volumes}
+        created = {spec['server_id']: waited['{}'.format(volume['id'])] for (
+            spec, (volume, _)) in zip(specs, results) if volume}
+        errors = ['VM {}: {}'.format(spec['server_id'], e.message) for (
+            spec, (_, e)) in zip(specs, results) if e] + [
+                'volume {}: {}'.format(volume['id'], status(volume)) for (
+                    volume) in volumes if status(volume) == 'error']
+        volumes = [existing.get(server_id) or created.get(server_id) for (
+            server_id) in server_ids]
+        if errors:
+            self.fail_json(
+                msg='Failed to create {} of {} volumes'.format(
+                    len(errors), len(specs)),
+                msg_details='; '.join(errors),
+                volumes=[volume for volume in volumes if volume])
+        return self.result(bool(specs), volumes)
+
+    def attached(self):
+        """Attach the volume "id" to the VM "server_id", if it is free"""
+        volume, server_id = self.discover(), self.params.get('server_id')
+        if not volume:
+            self.fail_json(msg='Volume {} not found'.format(
+                self.params.get('id')))
+        servers = attached_to(volume)
+        if server_id in servers:
+            return dict(changed=False, volume=volume)
+        if servers:
+            self.fail_json(msg='Volume {} is attached to VM {}'.format(
+                volume['id'], ', '.join(servers)))
+        if self.plan(
+                'attach', 'volume', id=volume['id'], server_id=server_id):
+            return dict(changed=True, volume=volume)
+        try:
+            self.compute.attach_volume(server_id, volume['id'])
+        except ClientError as e:
+            self.fail_json(
+                msg='Failed to attach volume', msg_details=e.message)
+        volume = self.wait_volumes([volume], lambda v: status(v) == (
+            'error') or server_id in attached_to(v or dict()))[0]
+        return dict(changed=True, volume=volume)
+
+    def absent(self):
+        """Delete the volume "id", or the volumes named "name" of the VMs,
+           concurrently, and wait on them together
+        """
+        if self.params.get('id'):
+            volumes = [v for v in [self.discover()] if v]
+        else:
+            if not self.server_ids():
+                self.fail_json(
+                    msg='Volumes by name need a "server_id" or "servers"')
+            existing, volumes = self.by_server(), []
+            for server_id in self.server_ids():
+                volume = existing.get(server_id)
+                if volume and volume not in volumes:
+                    volumes.append(volume)
+        if self.check_mode:
+            for volume in volumes:
+                self.plan('delete', 'volume', id=volume['id'])
+            return dict(changed=bool(volumes), deleted=[
+                volume['id'] for volume in volumes])
+        results = self.run_parallel(self._delete, volumes)
+        errors = ['{}: {}'.format(volume['id'], e.message) for volume, (
+            _, e) in zip(volumes, results) if e]
+        self.wait_volumes(
+            [volume for volume, (id_, _) in zip(volumes, results) if id_],
+            gone)
+        if errors:
+            self.fail_json(
+                msg='Failed to delete {} of {} volumes'.format(
+                    len(errors), len(volumes)),
+                msg_details='; '.join(errors))
+        return dict(changed=bool(volumes), deleted=[
+            volume['id'] for volume in volumes])
+
+
+if __name__ == '__main__':
+    module = SNFVolume(
+        argument_spec={
+            'state': {
+                'default': 'present',
+                'choices': ['present', 'absent', 'attached']},
+            'cloud': {'required': True, 'type': 'dict'},
+            'per_cloud': {'required': False, 'type': 'dict'},
+            'id': {'required': False, 'type': 'str'},
+            'name': {'required': False, 'type': 'str'},
+            'size': {'required': False, 'type': 'int'},
+            'volume_type': {'required': False, 'type': 'str'},
+            'server_id': {'required': False, 'type': 'str'},
+            'servers': {'required': False, 'type': 'list'},
+            'workers': {'default': 10, 'type': 'int'},
+            'wait': {'default': True, 'type': 'bool'},
+            'wait_timeout': {'default': 100, 'type': 'int'},
+            'transport_stats': {'default': False, 'type': 'bool'},
+            'api_stats': {'default': False, 'type': 'bool'},
+            'api_trace': {'required': False, 'type': 'path'},
+        },
+        required_if=(
+            ('state', 'present', ('name', 'size')),
+            ('state', 'attached', ('id', 'server_id')),
+            ('state', 'absent', ('id', 'name'), True),
+        ),
+        mutually_exclusive=(('server_id', 'servers'), ),
+        supports_check_mode=True,
+    )
+    module.run({
+        'present': module.present,
+        'absent': module.absent,
+        'attached': module.attached,
+    }[module.params['state']])
@@ -0,0 +1,302 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""A long-lived local process holding warm kamaki clients for the modules
+
+Modules pay, per task, for patching SSL, TLS handshakes and authentication.
+The broker pays once: it keeps kamaki clients, their keep-alive connections
+and the endpoint catalog of every token across tasks. Modules forward their
+kamaki calls to it over a unix socket, as JSON lines, with BrokerClient.
+It exits after some idle time.
+"""
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import time
+from threading import Lock, Thread, local
+try:
+    from SocketServer import (
+        StreamRequestHandler, ThreadingMixIn, UnixStreamServer)
+except ImportError:
+    from socketserver import (
+        StreamRequestHandler, ThreadingMixIn, UnixStreamServer)
+from kamaki.clients import ClientError
+from kamaki.clients.astakos import AstakosClient
+from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
+from ansible.module_utils.snf_cache import cache_key, parse_expiry
+from ansible.module_utils.snf_limit import TokenBucket
+
+DEFAULT_IDLE = 600
+# Memoized results live until the token expires, or this long if unknown
+MEMO_TTL = 3600
+
+# Client name: (kamaki class, cloud url key)
+CLIENTS = {
+    'astakos': (AstakosClient, 'url'),
+    'compute': (CycladesClient, 'compute_url'),
+    'network': (CycladesNetworkClient, 'network_url'),
+}
+# Calls answered from memory after the first time, per url and token,
+# until the token expires
+MEMOIZED = ('astakos.authenticate', 'astakos.get_endpoint_url')
+# The cloud keys a broker needs
+CLOUD_KEYS = (
+    'url', 'token', 'compute_url', 'network_url', 'rate_limit', 'rate_burst',
+    'cache_dir')
+
+
+def socket_name(url, token, ca_certs=None):
+    """A broker serves one cloud, with the certificates it started with
+       returns: the socket file name of the broker of a cloud
+    """
+    key = '{}:{}'.format(cache_key(url, token), ca_certs or '')
+    return 'broker-{}.sock'.format(
+        hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+
+
+class Broker(object):
+    """Run kamaki calls for the modules, with clients kept per thread and
+       per cloud, connections pooled by Transport
+    """
+
+    def __init__(self, idle=DEFAULT_IDLE):
+        self.idle, self.last, self.active = idle, time.time(), 0
+        self._clients, self._lock = local(), Lock()
+        self._memo, self._buckets, self._expires = dict(), dict(), dict()
+
+    def client(self, name, cloud):
+        clients = getattr(self._clients, 'clients', None)
+        if clients is None:
+            clients = self._clients.clients = dict()
+        client_class, url_key = CLIENTS[name]
+        key = (name, cloud.get(url_key), cloud.get('token'))
+        if key not in clients:
+            clients[key] = client_class(key[1], key[2])
+        return clients[key]
+
+    def bucket(self, cloud):
+        key = (cloud.get('url'), cloud.get('token'))
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket.for_cloud(cloud)
+            return self._buckets[key]
+
+    def expiry(self, op, cloud, result):
+        """Authentications tell when the token expires
+           returns: when a memoized result expires
+        """
+        key = (cloud.get('url'), cloud.get('token'))
+        if op == 'astakos.authenticate':
+            token = ((result or dict()).get('access') or dict()).get('token')
+            expires = parse_expiry((token or dict()).get('expires'))
+            if expires:
+                self._expires[key] = expires
+        return self._expires.get(key) or time.time() + MEMO_TTL
+
+    def call(self, name, method, args, kwargs, cloud):
+        if method.startswith('_') or name not in CLIENTS:
+            raise ClientError('{}.{} is not allowed'.format(name, method), 400)
+        op = '{}.{}'.format(name, method)
+        memo_key = None
+        if op in MEMOIZED:
+            memo_key = json.dumps(
+                [op, cloud.get('url'), cloud.get('token'), args, kwargs],
+                sort_keys=True)
+            with self._lock:
+                expires, result = self._memo.get(memo_key, (0, None))
+                if expires > time.time():
+                    return result
+        bucket = self.bucket(cloud)
+        if bucket:
+            bucket.acquire()
+        result = getattr(self.client(name, cloud), method)(*args, **kwargs)
+        if memo_key:
+            with self._lock:
+                now = time.time()
+                self._memo = {k: v for k, v in self._memo.items() if (
+                    v[0] > now)}
+                self._memo[memo_key] = (self.expiry(op, cloud, result), result)
+        return result
+
+    def handle(self, request):
+        """returns: a response to a request, {"result": ...} or {"error":
+           {"message": ..., "status": ..., "details": ...}}
+        """
+        with self._lock:
+            self.last, self.active = time.time(), self.active + 1
+        try:
+            if request.get('op') == 'ping':
+                return dict(result=os.getpid())
+            return dict(result=self.call(
+                request['client'], request['method'],
+                request.get('args') or [], request.get('kwargs') or dict(),
+                request['cloud']))
+        except ClientError as e:
+            return dict(error=dict(
+                message=e.message, status=e.status,
+                details=getattr(e, 'details', None)))
+        except Exception as e:
+            return dict(error=dict(
+                message='Broker error: {}'.format(e), status=500))
+        finally:
+            with self._lock:
+                self.last, self.active = time.time(), self.active - 1
+
+    def expired(self):
+        with self._lock:
+            return not self.active and time.time() - self.last > self.idle
+
+
+class _Handler(StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                response = self.server.broker.handle(json.loads(
+                    line.decode('utf-8')))
+            except ValueError as e:
+                response = dict(error=dict(
+                    message='Bad request: {}'.format(e), status=400))
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class BrokerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, broker):
+        self.broker = broker
+        UnixStreamServer.__init__(self, path, _Handler)
+        os.chmod(path, 0o600)
+
+
+def ping(path, timeout=1):
+    """returns: the pid of the broker listening on path, or None"""
+    try:
+        client = BrokerClient(path, None, dict(), timeout)
+        try:
+            return client._request(dict(op='ping'))
+        finally:
+            client._close()
+    except (ClientError, socket.error, ValueError):
+        return None
+
+
+def serve(path, idle=DEFAULT_IDLE, ca_certs=None):
+    """Listen on path until idle for idle seconds
+       Only one broker starts per path, the others return
+    """
+    # snf_common uses the broker, import it only when serving
+    from ansible.module_utils.snf_common import Transport
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if ping(path):
+                return
+            try:
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            Transport.install(ca_certs)
+            server = BrokerServer(path, Broker(idle))
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _watch():
+        while not server.broker.expired():
+            time.sleep(min(5, server.broker.idle))
+        server.shutdown()
+    watcher = Thread(target=_watch)
+    watcher.daemon = True
+    watcher.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def spawn(path, idle=DEFAULT_IDLE, ca_certs=None, timeout=5):
+    """Start a detached broker on path, unless one is already listening
+       returns: the pid of the broker, or None if it did not start in time
+    """
+    pid = ping(path)
+    if pid:
+        return pid
+    child = os.fork()
+    if child == 0:
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                serve(path, idle, ca_certs)
+        finally:
+            os._exit(0)
+    os.waitpid(child, 0)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pid = ping(path)
+        if pid:
+            return pid
+        time.sleep(0.05)
+    return None
+
+
+class BrokerClient(object):
+    """A kamaki client proxy: calls run in the broker, ClientErrors are
+       raised here. Like kamaki clients, each thread needs its own.
+    """
+
+    def __init__(self, path, name, cloud, timeout=None):
+        self._path, self._name, self._timeout = path, name, timeout
+        self._cloud = {k: v for k, v in cloud.items() if k in CLOUD_KEYS}
+        self._sock = self._rfile = None
+
+    def _close(self):
+        for stream in (self._rfile, self._sock):
+            if stream:
+                stream.close()
+        self._sock = self._rfile = None
+
+    def _request(self, request):
+        try:
+            if not self._sock:
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.settimeout(self._timeout)
+                self._sock.connect(self._path)
+                self._rfile = self._sock.makefile('rb')
+            self._sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            line = self._rfile.readline()
+        except socket.error as e:
+            self._close()
+            raise ClientError('Broker unreachable: {}'.format(e), 0)
+        if not line:
+            self._close()
+            raise ClientError('Broker closed the connection', 0)
+        response = json.loads(line.decode('utf-8'))
+        error = response.get('error')
+        if error:
+            raise ClientError(
+                error['message'], error.get('status') or 0,
+                error.get('details'))
+        return response['result']
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        def call(*args, **kwargs):
+            return self._request(dict(
+                op='call', client=self._name, method=attr, args=args,
+                kwargs=kwargs, cloud=self._cloud))
+        return call
@@ -0,0 +1,458 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import calendar
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.path.join('~', '.cache', 'kamaki-ansible-role')
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CATALOG_TTL = 3600
+
+# Never keep secrets returned by create calls on disk
+SECRET_FIELDS = ('adminPass', 'private_key')
+
+# Resource type: (id field, indexed lookup fields)
+KINDS = {
+    'servers': ('id', ('name', )),
+    'networks': ('id', ('name', )),
+    'ports': ('id', ()),
+    'floatingips': ('id', ('floating_ip_address', )),
+    'keypairs': ('name', ('fingerprint', )),
+}
+# Resource types refreshed with the changes since the last sync, which
+# include the deleted records (Cyclades "changes-since"), for up to a day
+DELTA_KINDS = ('servers', )
+DELTA_MAX_AGE = 24 * 3600
+
+
+def cache_dir(cloud):
+    """returns: the (existing) cache directory of this cloud"""
+    path = os.path.expanduser(cloud.get('cache_dir') or DEFAULT_CACHE_DIR)
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def parse_expiry(timestamp):
+    """returns: seconds since epoch from an Astakos token expiry date
+       e.g., "2018-05-09T13:20:43.946497+00:00", or None if not parsable
+    """
+    try:
+        return calendar.timegm(time.strptime(
+            timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def snapshot_index(kind, records):
+    """Index a full listing of a resource type, e.g., for snf_facts
+       returns: {'ids': {id: record}, <lookup field>: {value: id}, ...}
+    """
+    id_field, fields = KINDS[kind]
+    index = {field: dict() for field in fields}
+    index['ids'] = dict()
+    for record in records:
+        id_ = '{}'.format(record[id_field])
+        index['ids'][id_] = record
+        for field in fields:
+            value = record.get(field)
+            if value is not None:
+                index[field].setdefault('{}'.format(value), id_)
+    return index
+
+
+def cache_key(url, token):
+    """returns: a file-safe key from a cloud url and a token hash"""
+    token_hash = hashlib.sha256('{}'.format(token).encode('utf-8'))
+    key = '{}:{}'.format(url, token_hash.hexdigest())
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class CacheFile(object):
+    """A JSON file, shared by concurrent module runs (e.g., ansible forks)
+       Reads are lock-free, because writes replace the file atomically.
+       Updates are serialized with an exclusive lock on a side file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def _write(self, data):
+        dirname = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def update(self, func):
+        """Read, modify with func(data) and write back, under lock
+           returns: the updated data
+        """
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                data = self.load()
+                func(data)
+                self._write(data)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return data
+
+
+class DiscoveryCache(object):
+    """On-controller cache of Synnefo resources, shared by the modules
+       There is one file per cloud url and token. For every resource type
+       (e.g., "servers"), it holds the records by id, an index per lookup
+       field (e.g., "name") and the time of the last full listing.
+       Records expire after "cache_ttl" seconds, the oldest ones are evicted
+       when there are more than "cache_size" of them. Modules write through
+       every create, rename or delete, so that lookups stay accurate.
+       If "cache_ttl" is not set in cloud, the cache is disabled, unless it is
+       preloaded with a snapshot for the duration of a module run.
+       Listings of DELTA_KINDS also keep a watermark, the latest "updated"
+       time of their records, and are refreshed with the changes since then
+       (see apply). Their records outlive "cache_ttl", until the next sync,
+       but lookups ignore them once the listing is older than "cache_ttl".
+    """
+
+    def __init__(self, cloud):
+        self.ttl = int(cloud.get('cache_ttl') or 0)
+        self.size = int(cloud.get('cache_size') or DEFAULT_CACHE_SIZE)
+        self._data, self._file, self._pinned = dict(), None, False
+        if self.ttl > 0:
+            key = cache_key(cloud.get('url'), cloud.get('token'))
+            self._file = CacheFile(
+                os.path.join(cache_dir(cloud), key + '.json'))
+            self._data = self._file.load()
+            self._expire(self._data)
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def preload(self, snapshot):
+        """Pin lookups of this run to a snapshot (see snf_facts), in memory
+           Writes still go through to the disk cache, if enabled
+        """
+        now, self._pinned, self._data = time.time(), True, dict()
+        for kind, index in snapshot.items():
+            if kind not in KINDS:
+                continue
+            entry = self._entry(self._data, kind)
+            entry['records'] = {
+                id_: (now, record) for id_, record in index['ids'].items()}
+            for field in entry['indexes']:
+                entry['indexes'][field] = dict(index.get(field, dict()))
+            entry['listed'] = now
+
+    # Data manipulation, on loaded or locked data
+    def _expire(self, data):
+        if self.ttl <= 0:
+            return
+        now = time.time()
+        for kind, entry in data.items():
+            records = entry.setdefault('records', dict())
+            synced = entry.get('synced') and (
+                now - entry.get('synced_at', 0) <= DELTA_MAX_AGE)
+            old = [] if synced else [
+                k for k, (t, _) in records.items() if now - t > self.ttl]
+            if len(records) - len(old) > self.size:
+                fresh = sorted(
+                    (t, k) for k, (t, _) in records.items() if k not in old)
+                old += [k for _, k in fresh[:len(fresh) - self.size]]
+            if old:
+                for id_ in old:
+                    self._unindex(entry, records.pop(id_, (0, {}))[1])
+                entry['listed'] = entry['synced'] = None
+            if now - (entry.get('listed') or 0) > self.ttl:
+                entry['listed'] = None
+
+    @staticmethod
+    def _entry(data, kind):
+        id_field, fields = KINDS[kind]
+        entry = data.setdefault(kind, dict())
+        entry.setdefault('records', dict())
+        entry.setdefault('listed', None)
+        entry['id_field'] = id_field
+        indexes = entry.setdefault('indexes', dict())
+        for field in fields:
+            indexes.setdefault(field, dict())
+        return entry
+
+    @staticmethod
+    def _watermark(entry, records):
+        times = [r['updated'] for r in records if r.get('updated')]
+        if entry.get('synced'):
+            times.append(entry['synced'])
+        return max(times) if times else None
+
+    @staticmethod
+    def _unindex(entry, record):
+        id_ = '{}'.format(record.get(entry.get('id_field', 'id')))
+        for field, index in entry.get('indexes', dict()).items():
+            if index.get('{}'.format(record.get(field))) == id_:
+                index.pop('{}'.format(record.get(field)))
+
+    @staticmethod
+    def _index(entry, record, replace=True):
+        id_ = '{}'.format(record.get(entry['id_field']))
+        for field, index in entry['indexes'].items():
+            value = record.get(field)
+            if value is not None and (replace or (
+                    '{}'.format(value) not in index)):
+                index['{}'.format(value)] = id_
+
+    @staticmethod
+    def _clean(record):
+        return {k: v for k, v in record.items() if k not in SECRET_FIELDS}
+
+    def _update(self, func):
+        if self.enabled:
+            data = self._file.update(func)
+            if not self._pinned:
+                self._data = data
+        if self._pinned:
+            func(self._data)
+
+    # Reads: local, no API calls
+    def get(self, kind, id_):
+        """returns: the cached record with this id, or None"""
+        entry = self._data.get(kind, dict())
+        if entry.get('synced') and not entry.get('listed'):
+            # Kept for the next sync, too old for lookups
+            return None
+        record = entry.get('records', dict()).get('{}'.format(id_))
+        return record[1] if record else None
+
+    def lookup(self, kind, field, value):
+        """Look up a record by an indexed field (e.g., name)
+           returns: (hit, record), where a hit with no record means that the
+               last full listing is fresh and contains no such record
+        """
+        entry = self._data.get(kind, dict())
+        id_ = entry.get('indexes', dict()).get(field, dict()).get(
+            '{}'.format(value))
+        record = self.get(kind, id_) if id_ is not None else None
+        if record:
+            return True, record
+        return bool(entry.get('listed')), None
+
+    def listing(self, kind):
+        """returns: all records of a fresh full listing, or None"""
+        entry = self._data.get(kind, dict())
+        if not entry.get('listed'):
+            return None
+        return [r for _, r in entry.get('records', dict()).values()]
+
+    def watermark(self, kind):
+        """returns: the time to list the changes of a kind since, or None"""
+        if kind not in DELTA_KINDS:
+            return None
+        return self._data.get(kind, dict()).get('synced')
+
+    # Writes: keep the cache in sync with the cloud
+    def store(self, kind, records):
+        """Replace the cached records with a full listing"""
+        def _store(data):
+            now = time.time()
+            data.pop(kind, None)
+            entry = self._entry(data, kind)
+            for record in records:
+                entry['records']['{}'.format(record[entry['id_field']])] = (
+                    now, self._clean(record))
+                self._index(entry, record, replace=False)
+            entry['listed'] = now
+            if kind in DELTA_KINDS:
+                entry['synced'] = self._watermark(entry, records)
+                entry['synced_at'] = now
+            self._expire(data)
+        self._update(_store)
+
+    def apply(self, kind, changes):
+        """Bring a synced listing up to date with the changes since its
+           watermark, including deletions (status "DELETED")
+           returns: the updated listing, or None if it is no longer synced
+               (e.g., some records were evicted meanwhile)
+        """
+        def _apply(data):
+            now = time.time()
+            entry = self._entry(data, kind)
+            if not entry.get('synced'):
+                return
+            for record in changes:
+                id_ = '{}'.format(record[entry['id_field']])
+                old = entry['records'].pop(id_, None)
+                if old:
+                    self._unindex(entry, old[1])
+                if record.get('status') != 'DELETED':
+                    entry['records'][id_] = (now, self._clean(record))
+                    self._index(entry, record)
+            entry['synced'] = self._watermark(entry, changes)
+            entry['listed'] = entry['synced_at'] = now
+            self._expire(data)
+        self._update(_apply)
+        return self.listing(kind)
+
+    def put(self, kind, record):
+        """Add or replace a (full) record, e.g., after a create or rename"""
+        def _put(data):
+            entry = self._entry(data, kind)
+            id_ = '{}'.format(record[entry['id_field']])
+            old = entry['records'].pop(id_, None)
+            if old:
+                self._unindex(entry, old[1])
+            entry['records'][id_] = (time.time(), self._clean(record))
+            self._index(entry, record)
+            self._expire(data)
+        self._update(_put)
+
+    def drop(self, kind, id_):
+        """Forget a record, e.g., after a delete"""
+        def _drop(data):
+            entry = data.get(kind, dict())
+            old = entry.get('records', dict()).pop('{}'.format(id_), None)
+            if old:
+                self._unindex(entry, old[1])
+        self._update(_drop)
+
+    def invalidate(self, kind):
+        """The last full listing of this kind is no longer complete"""
+        def _invalidate(data):
+            if kind in data:
+                data[kind]['listed'] = None
+        self._update(_invalidate)
+
+    def stale(self, kind, id_):
+        """Forget a record that still exists, but changed out of band (e.g.,
+           a server after a port is attached), so that lookups will not take
+           it for deleted
+        """
+        def _stale(data):
+            entry = data.get(kind, dict())
+            old = entry.get('records', dict()).pop('{}'.format(id_), None)
+            if old:
+                self._unindex(entry, old[1])
+            if entry:
+                entry['listed'] = None
+        self._update(_stale)
+
+
+class CatalogCache(object):
+    """On-controller cache of the flavors and images a token can see, which
+       rarely change: each catalog is listed once per "catalog_ttl" seconds
+       (default: an hour) and shared by all module runs. If "catalog_ttl" is
+       0, catalogs are kept for the duration of a module run only.
+    """
+
+    def __init__(self, cloud):
+        ttl = cloud.get('catalog_ttl')
+        self.ttl = int(DEFAULT_CATALOG_TTL if ttl is None else ttl)
+        self._data, self._file = dict(), None
+        if self.ttl > 0:
+            key = cache_key(cloud.get('url'), cloud.get('token'))
+            self._file = CacheFile(
+                os.path.join(cache_dir(cloud), key + '.catalog.json'))
+            self._data = self._file.load()
+
+    def get(self, kind):
+        """returns: the records of a fresh catalog (e.g., "flavors"), or None
+        """
+        entry = self._data.get(kind)
+        if entry and (self.ttl <= 0 or (
+                time.time() - entry['listed'] <= self.ttl)):
+            return entry['records']
+        return None
+
+    def store(self, kind, records):
+        def _store(data):
+            data[kind] = dict(listed=time.time(), records=records)
+        if self._file:
+            self._data = self._file.update(_store)
+        else:
+            _store(self._data)
+
+
+class SessionCache(object):
+    """On-controller cache of what a token can see, valid until it expires:
+       the service endpoint catalog and the state of the projects checked.
+       If the token expiry is not known, entries live for "cache_ttl" seconds.
+       If "cache_ttl" is not set in cloud, the cache is disabled.
+    """
+
+    def __init__(self, cloud):
+        self.ttl = int(cloud.get('cache_ttl') or 0)
+        self._data, self._file = dict(), None
+        if self.ttl > 0:
+            key = cache_key(cloud.get('url'), cloud.get('token'))
+            self._file = CacheFile(
+                os.path.join(cache_dir(cloud), key + '.session.json'))
+            self._data = self._file.load()
+            if time.time() >= self._data.get('expires', 0):
+                self._data = dict()
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    @property
+    def endpoints(self):
+        """returns: {service type: url} or an empty dict"""
+        return self._data.get('endpoints', dict())
+
+    @property
+    def catalog(self):
+        """returns: {service type: url} for every service, or None"""
+        return self.endpoints if self._data.get('catalog') else None
+
+    def project(self, project_id):
+        """returns: the cached project, or None"""
+        return self._data.get('projects', dict()).get(project_id)
+
+    def _update(self, func, expires=None):
+        if not self.enabled:
+            return
+
+        def _func(data):
+            now = time.time()
+            if now >= data.get('expires', 0):
+                data.clear()
+            if expires:
+                data['expires'] = expires
+            else:
+                data.setdefault('expires', now + self.ttl)
+            func(data)
+        self._data = self._file.update(_func)
+
+    def save_endpoints(self, endpoints, expires=None, catalog=False):
+        """Merge {service type: url} to the cached endpoints
+           expires: (seconds since epoch) when the token expires, if known
+           catalog: (bool) endpoints contain every service
+        """
+        def _save(data):
+            data.setdefault('endpoints', dict()).update(endpoints)
+            data['catalog'] = catalog or data.get('catalog', False)
+        self._update(_save, expires)
+
+    def save_project(self, project):
+        self._update(
+            lambda data: data.setdefault('projects', dict()).update(
+                {project['id']: project}))
@@ -0,0 +1,48 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""Select flavors and images by spec, from their catalogs (see CatalogCache)
+
+A flavor spec sets the minimum "vcpus", "ram" (MB) and "disk" (GB) and,
+optionally, the "disk_template" or the "name", e.g.,
+{"vcpus": 2, "ram": 4096, "disk_template": "drbd"}.
+An image spec sets the "name" and the image metadata to match, e.g.,
+{"os": "debian", "osfamily": "linux"}.
+"""
+DISK_TEMPLATE = 'SNF:disk_template'
+ALLOW_CREATE = 'SNF:allow_create'
+FLAVOR_SIZES = ('vcpus', 'ram', 'disk')
+
+
+def _size(flavor):
+    return tuple(int(flavor.get(key) or 0) for key in FLAVOR_SIZES)
+
+
+def select_flavor(flavors, spec):
+    """returns: the smallest flavor that satisfies spec, or None"""
+    def _fits(flavor):
+        return flavor.get(ALLOW_CREATE, True) and all(
+            int(flavor.get(key) or 0) >= int(spec[key]) for key in (
+                FLAVOR_SIZES) if spec.get(key) is not None) and all(
+            '{}'.format(flavor.get(field)) == '{}'.format(spec[key]) for (
+                key, field) in (
+                    ('disk_template', DISK_TEMPLATE), ('name', 'name')) if (
+                spec.get(key) is not None))
+    fit = [flavor for flavor in flavors if _fits(flavor)]
+    return min(fit, key=lambda flavor: (
+        _size(flavor), '{}'.format(flavor['id']))) if fit else None
+
+
+def select_image(images, spec):
+    """Values are compared regardless of case
+       returns: the latest image that satisfies spec, or None
+    """
+    def _value(value):
+        return '{}'.format(value).lower()
+
+    def _fits(image):
+        metadata = image.get('metadata') or dict()
+        return image.get('status', 'ACTIVE') == 'ACTIVE' and all(_value(
+            image.get(key) if key == 'name' else metadata.get(key)) == (
+                _value(value)) for key, value in spec.items())
+    fit = [image for image in images if _fits(image)]
+    return max(fit, key=lambda image: (
+        image.get('updated') or '', '{}'.format(image['id']))) if fit else None
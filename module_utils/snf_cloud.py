@@ -0,0 +1,27 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+from ansible.module_utils.snf_cache import parse_expiry
+
+
+def service_endpoints(access):
+    """returns: {service type: public url} of an Astakos authentication"""
+    endpoints = dict()
+    for service in access.get('serviceCatalog', []):
+        for endpoint in service.get('endpoints', [])[:1]:
+            endpoints[service['type']] = endpoint['publicURL']
+    return endpoints
+
+
+def endpoint_catalog(astakos, session):
+    """Resolve the endpoints of every service in one authentication
+       Used by the cloud module and the synnefo inventory plugin
+       session: a SessionCache, to reuse and to keep the catalog
+       returns: {service type: public url}
+       raises: ClientError
+    """
+    if session.catalog:
+        return session.catalog
+    access = astakos.authenticate()['access']
+    endpoints = service_endpoints(access)
+    session.save_endpoints(
+        endpoints, parse_expiry(access['token'].get('expires')), True)
+    return endpoints
@@ -0,0 +1,418 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import base64
+import hashlib
+import time
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+from kamaki.clients import ClientError, RequestManager
+from kamaki.clients.astakos import AstakosClient
+from kamaki.clients.cyclades import CycladesClient, CycladesNetworkClient
+from kamaki.clients.utils import https
+from objpool import http as objpool_http
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.snf_broker import CLIENTS as BROKER_CLIENTS
+from ansible.module_utils.snf_broker import BrokerClient, ping
+from ansible.module_utils.snf_cache import CatalogCache, DiscoveryCache
+from ansible.module_utils.snf_cloud import service_endpoints
+from ansible.module_utils.snf_fanout import (
+    fan_out, report, summary, target_name)
+from ansible.module_utils.snf_limit import (
+    DEFAULT_RETRIES, Retrying, TokenBucket)
+from ansible.module_utils.snf_trace import Tracer, Traced, http_performed
+from ansible.module_utils.snf_wait import server_waiter, port_waiter
+
+
+def run_parallel(func, items, workers):
+    """Call func on each item through a bounded pool of worker threads
+       Workers must not call fail_json, so ClientErrors are caught and
+       returned instead.
+       returns: a list of (result, error) tuples, in the order of items
+    """
+    def _safe(item):
+        try:
+            return func(item), None
+        except ClientError as e:
+            return None, e
+    if not items:
+        return []
+    pool = ThreadPool(max(1, min(workers or 1, len(items))))
+    try:
+        return pool.map(_safe, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def key_fingerprint(public_key):
+    """MD5 fingerprint of an SSH public key, regardless of its comment and
+       whitespace, e.g., "ssh-rsa AAAA... user@host"
+       returns: e.g., "43:51:43:a1:b5:fc:8b:b7:0a:3a:a9:b1:0f:66:73:a8",
+           or None if the key cannot be parsed
+    """
+    try:
+        blob = base64.b64decode(public_key.split()[1].encode('ascii'))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+    digest = hashlib.md5(blob).hexdigest()
+    return ':'.join(digest[i:i + 2] for i in range(0, len(digest), 2))
+
+
+def with_fingerprint(pair):
+    """returns: a keypair with the fingerprint of its public key, so that
+       fingerprints of listed and local keys are always comparable
+    """
+    return dict(pair, fingerprint=key_fingerprint(pair.get('public_key')))
+
+
+class Transport(object):
+    """Keep-alive HTTP(S) transport, shared by every kamaki client
+       kamaki pools connections per scheme and host (with objpool), so all
+       clients of a module run reuse the same connections, instead of paying
+       a TCP and TLS handshake per request. Counters show how many requests
+       were served by how many connections (i.e., handshakes).
+       Requests wait for a token of the bucket, if throttled (see throttle).
+    """
+    _lock, _installed, bucket = Lock(), False, None
+    requests, connections = 0, 0
+
+    @classmethod
+    def _count(cls, klass, method_name, counter, hook=None, before=None):
+        method = getattr(klass, method_name)
+
+        def counted(self, *args, **kwargs):
+            with cls._lock:
+                setattr(cls, counter, getattr(cls, counter) + 1)
+            if before:
+                before()
+            result = method(self, *args, **kwargs)
+            if hook:
+                hook(self, result)
+            return result
+        setattr(klass, method_name, counted)
+
+    @classmethod
+    def install(cls, ca_certs=None, poolsize=None):
+        """Patch kamaki SSL settings, size the pools, count once per process
+           poolsize: at least as many connections as the concurrent workers
+        """
+        if ca_certs:
+            https.patch_with_certs(ca_certs)
+        else:
+            https.patch_ignore_ssl()
+        if cls._installed:
+            return
+        if poolsize and poolsize > objpool_http.default_pool_size:
+            objpool_http.init_http_pooling(poolsize)
+        classes = set(
+            objpool_http.HTTPConnectionPool._scheme_to_class.values())
+        for conn_class in classes:
+            cls._count(conn_class, 'connect', 'connections')
+        cls._count(
+            RequestManager, 'perform', 'requests', http_performed,
+            lambda: cls.bucket and cls.bucket.acquire())
+        cls._installed = True
+
+    @classmethod
+    def throttle(cls, bucket):
+        """:param bucket: (TokenBucket) shared by all requests, or None"""
+        cls.bucket = bucket
+
+    @classmethod
+    def stats(cls):
+        return dict(
+            requests=cls.requests, connections=cls.connections,
+            reused=max(0, cls.requests - cls.connections),
+            retries=Retrying.retries, throttled=TokenBucket.throttled,
+            throttled_seconds=round(TokenBucket.waited, 2))
+
+
+class SNFModule(AnsibleModule):
+    """Parent class of modules operating on a cloud (see the cloud module)
+       Set up the shared transport and cache, provide the kamaki clients
+       and the helpers to run and wait on many resources at once.
+       Resources are looked up in the "facts" snapshot, if given (see the
+       snf_facts module).
+       In check mode, changes are planned instead of made (see plan).
+       If the cloud has a running broker, kamaki calls run there.
+       With many clouds (see the cloud module "clouds"), the state function
+       runs on all of them concurrently (see run).
+    """
+    cloud, _access = None, None
+
+    def __init__(self, *args, **kw):
+        super(SNFModule, self).__init__(*args, **kw)
+        self.tracer = None
+        if self.params.get('api_stats') or self.params.get('api_trace'):
+            self.tracer = Tracer(
+                type(self).__name__, self.params.get('api_trace'))
+        self.waits, self.changes = [], []
+        cloud = self.params.get('cloud')
+        self.targets = cloud.get('clouds') or [cloud.get('cloud')]
+        if len(self.targets) == 1:
+            self.bind(self.targets[0])
+
+    def setup(self):
+        """Prepare a run from the parameters, once they are bound to a cloud
+        """
+
+    def bind(self, cloud):
+        """Bind the module to a cloud: its cache, clients and parameters
+           Parameters registered from a task on many clouds, i.e., with a
+           result per cloud, resolve to the result of this cloud, e.g.,
+           {"results": {"okeanos": {"network": ...}}} -> {"network": ...}
+           Parameters in "per_cloud" override the others for this cloud.
+        """
+        name = target_name(cloud)
+        for key, value in list(self.params.items()):
+            results = value.get('results') if key != 'cloud' and (
+                isinstance(value, dict)) else None
+            if isinstance(results, dict) and name in results:
+                self.params[key] = results[name]
+        self.params.update(
+            (self.params.get('per_cloud') or dict()).get(name) or dict())
+        self.cloud = cloud
+        self.cache = DiscoveryCache(self.cloud)
+        self.catalogs = None
+        facts = (self.params.get('facts') or dict()).get('facts')
+        if facts:
+            self.cache.preload(facts)
+        self._clients, self._installed, self._lock = local(), False, Lock()
+        self.broker = self.cloud.get('broker')
+        if self.broker and not ping(self.broker):
+            self.broker = None
+        if not self.broker:
+            self._install()
+        self.retries = self.cloud.get('retries', DEFAULT_RETRIES)
+        self.setup()
+
+    def run(self, func):
+        """Run a state function (e.g., self.present) and exit
+           On many clouds, run it on each one in its own process and report
+           the result of each one in "results"
+        """
+        if self.cloud:
+            self.exit_json(**func())
+
+        def _on(cloud):
+            self.bind(cloud)
+            return func()
+        result, error = summary(fan_out(self, self.targets, _on))
+        if error:
+            self.fail_json(msg=error, **result)
+        self.exit_json(**result)
+
+    def _install(self):
+        """Set up the transport and the throttle of local clients, once per
+           cloud: always without a broker, on the first local client with one
+        """
+        with self._lock:
+            if self._installed:
+                return
+            self._installed = True
+        start = time.time()
+        try:
+            Transport.install(
+                self.cloud.get('ca_certs'), self.params.get('workers'))
+        except Exception as e:
+            self.fail_json(
+                msg="Certificates (ca_certs) failed to patch kamaki",
+                msg_details="{}".format(e))
+        if self.tracer:
+            self.tracer.record('transport.install', time.time() - start)
+        Transport.throttle(TokenBucket.for_cloud(self.cloud))
+
+    def _reports(self, kwargs):
+        """Add the reports asked for to a result, even to early failures"""
+        if getattr(self, 'waits', None):
+            kwargs['waits'] = self.waits
+        params = getattr(self, 'params', None) or dict()
+        if params.get('transport_stats'):
+            kwargs['transport'] = Transport.stats()
+        if getattr(self, 'tracer', None) and params.get('api_stats'):
+            kwargs['api_stats'] = self.tracer.summary()
+        if getattr(self, 'check_mode', False):
+            kwargs['plan'] = getattr(self, 'changes', [])
+        return kwargs
+
+    def exit_json(self, **kwargs):
+        kwargs = self._reports(kwargs)
+        report(self, kwargs, False)
+        super(SNFModule, self).exit_json(**kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs = self._reports(kwargs)
+        report(self, kwargs, True)
+        super(SNFModule, self).fail_json(**kwargs)
+
+    # General purpose SNF methods and properties
+    def _client(self, name, client_class, url_key, **kwargs):
+        """kamaki clients keep per-request state, so every thread gets its
+           own clients. They are cheap: connections are pooled by Transport.
+           Calls are retried when throttled (see Retrying), each attempt is
+           traced. Clients the broker does not hold are always local, so
+           they get the transport (ca_certs) and the throttle of the cloud.
+        """
+        client = getattr(self._clients, name, None)
+        if not client:
+            url, token = self.cloud.get(url_key), self.cloud.get('token')
+            brokered = self.broker and name in BROKER_CLIENTS
+            if not brokered:
+                self._install()
+            try:
+                client = BrokerClient(self.broker, name, self.cloud) if (
+                    brokered) else client_class(url, token, **kwargs)
+            except ClientError as e:
+                self.fail_json(
+                    msg="{} Client initialization failed".format(
+                        name.capitalize()),
+                    msg_details=e.message)
+            if self.tracer:
+                client = Traced(client, self.tracer, name)
+            if self.retries:
+                client = Retrying(client, self.retries)
+            setattr(self._clients, name, client)
+        return client
+
+    @property
+    def astakos(self):
+        return self._client('astakos', AstakosClient, 'url')
+
+    @property
+    def compute(self):
+        return self._client('compute', CycladesClient, 'compute_url')
+
+    @property
+    def network(self):
+        return self._client('network', CycladesNetworkClient, 'network_url')
+
+    def authenticate(self):
+        """returns: the Astakos authentication of the token, made at most
+           once per run. Raises ClientError
+        """
+        if self._access is None:
+            self._access = self.astakos.authenticate()['access']
+        return self._access
+
+    def endpoint(self, service_type):
+        """The cloud module resolves the compute and network urls only
+           returns: the url of a service (e.g., "volume"), from the cloud
+               endpoints (see all_endpoints) or an authentication, or None.
+               Raises ClientError
+        """
+        url = (self.cloud.get('endpoints') or dict()).get(service_type)
+        return url or service_endpoints(self.authenticate()).get(
+            service_type)
+
+    def fetch(self, kind):
+        """returns: a fresh, detailed listing of a resource type, e.g.,
+           "servers" (see snf_cache.KINDS). Raises ClientError
+        """
+        return {
+            'servers': lambda: self.compute.list_servers(detail=True),
+            'networks': lambda: self.network.list_networks(detail=True),
+            'ports': lambda: self.network.list_ports(detail=True),
+            'floatingips': self.network.list_floatingips,
+            'keypairs': lambda: [
+                with_fingerprint(k) for k in self.compute.list_keypairs()],
+        }[kind]()
+
+    def listing(self, kind, fresh=False):
+        """returns: the cached listing of a resource type, if fresh enough,
+           or a new one, written through to the cache. Raises ClientError
+        """
+        records = None if fresh else self.cache.listing(kind)
+        if records is None:
+            records = self.sync(kind)
+        return records
+
+    def sync(self, kind):
+        """Refresh the cached listing of a resource type, with the changes
+           since the last sync if it has a watermark (see snf_cache), else
+           with a full listing. Raises ClientError
+           returns: the listing
+        """
+        since = self.cache.watermark(kind)
+        if since:
+            records = self.cache.apply(kind, self.compute.list_servers(
+                detail=True, changes_since=since))
+            if records is not None:
+                return records
+        records = self.fetch(kind)
+        self.cache.store(kind, records)
+        return records
+
+    def catalog(self, kind):
+        """returns: all the "flavors" or "images" of the cloud, from the
+           catalog cache if fresh enough. Raises ClientError
+        """
+        if self.catalogs is None:
+            self.catalogs = CatalogCache(self.cloud)
+        records = self.catalogs.get(kind)
+        if records is None:
+            records = {
+                'flavors': lambda: self.compute.list_flavors(detail=True),
+                'images': lambda: self.compute.list_images(detail=True),
+            }[kind]()
+            self.catalogs.store(kind, records)
+        return records
+
+    def find(self, kind, name):
+        """Look up a record by name, in the cache or else in a listing
+           Servers are looked up in the light listing (ids and names) and
+           only the first match is fetched in detail, so that the transfer
+           does not grow with the details of every VM, unless the cache can
+           sync them with their changes instead. Other kinds (e.g.,
+           networks) have no light listing, so their listing is cached.
+           Raises ClientError
+           returns: the detailed record, or None
+        """
+        hit, record = self.cache.lookup(kind, 'name', name)
+        if hit:
+            return record
+        if kind != 'servers' or self.cache.watermark(kind):
+            return next((r for r in self.listing(kind) if (
+                r.get('name') == name)), None)
+        for record in self.compute.list_servers(detail=False):
+            if record.get('name') != name:
+                continue
+            try:
+                record = self.compute.get_server_details(record['id'])
+            except ClientError as e:
+                # Deleted since the listing, look for another one
+                if e.status in (404, ):
+                    continue
+                raise
+            self.cache.put(kind, record)
+            return record
+        return None
+
+    def plan(self, action, kind, **details):
+        """In check mode, record a change instead of making it, e.g.,
+           {"action": "create", "kind": "server", "name": ...}
+           returns: True if the change must not be made (check mode)
+        """
+        if not self.check_mode:
+            return False
+        self.changes.append(dict(details, action=action, kind=kind))
+        return True
+
+    def run_parallel(self, func, items):
+        return run_parallel(func, items, self.params.get('workers'))
+
+    def wait_for(self, waiter, resources, stop):
+        """Wait on resources together, keep a report of the wait
+           returns: the last known details of each resource
+        """
+        if not (resources and self.params.get('wait')) or self.check_mode:
+            return resources
+        resources = waiter.wait_on(resources, stop)
+        self.waits.append(waiter.report())
+        return resources
+
+    def wait_servers(self, vms, stop):
+        waiter = server_waiter(self.compute, self.params.get('wait_timeout'))
+        return self.wait_for(waiter, vms, stop)
+
+    def wait_ports(self, ports, stop):
+        waiter = port_waiter(self.network, self.params.get('wait_timeout'))
+        return self.wait_for(waiter, ports, stop)
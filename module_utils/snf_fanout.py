@@ -0,0 +1,68 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import json
+import os
+
+
+def target_name(target):
+    """returns: the name of a cloud target, its project or url by default"""
+    return target.get('name') or target.get('project_id') or target.get('url')
+
+
+def fan_out(module, targets, func):
+    """Run func(target) on every target (e.g., a cloud) concurrently, each in
+       a forked process, so that targets share nothing and a fail_json on
+       one target does not stop the others. Children return their results
+       through module.exit_json or module.fail_json (see report).
+       returns: {target name: result}
+    """
+    children = []
+    for target in targets:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            module._result_fd = write_fd
+            try:
+                module.exit_json(**func(target))
+            except Exception as e:
+                module.fail_json(msg='Unexpected error: {}'.format(e))
+            finally:
+                os._exit(1)
+        os.close(write_fd)
+        children.append((target_name(target), pid, read_fd))
+    results = dict()
+    for name, pid, read_fd in children:
+        with os.fdopen(read_fd, 'rb') as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        try:
+            results[name] = json.loads(data.decode('utf-8'))
+        except ValueError:
+            results[name] = dict(
+                failed=True, msg='No result from "{}"'.format(name))
+    return results
+
+
+def report(module, result, failed):
+    """In a fan_out child, send the result to the parent and exit. Called
+       by exit_json and fail_json, does nothing in the parent process.
+    """
+    fd = getattr(module, '_result_fd', None)
+    if fd is None:
+        return
+    with os.fdopen(fd, 'wb') as f:
+        f.write(json.dumps(
+            dict(result, failed=failed), default=str).encode('utf-8'))
+    os._exit(0)
+
+
+def summary(results, what='clouds'):
+    """returns: (result, error message or None) of a fan_out"""
+    failed = sorted(name for name, r in results.items() if r.get('failed'))
+    result = dict(
+        changed=any(r.get('changed') for r in results.values()),
+        results=results)
+    if failed:
+        return result, 'Failed on {} of {} {}: {}'.format(
+            len(failed), len(results), what, ', '.join(failed))
+    return result, None
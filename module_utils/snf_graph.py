@@ -0,0 +1,115 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import time
+from threading import Condition
+from multiprocessing.pool import ThreadPool
+
+
+class DependencyFailed(Exception):
+    """A node was not run, because a node it depends on failed"""
+
+    def __init__(self, node, failed):
+        super(DependencyFailed, self).__init__(
+            '{} skipped, depends on failed {}'.format(
+                node, ', '.join('{}'.format(n) for n in failed)))
+        self.node, self.failed = node, failed
+        self.message = '{}'.format(self)
+
+
+class Graph(object):
+    """A dependency graph of operations, run concurrently
+       Each node runs as soon as all the nodes it depends on are done, so a
+       run takes about as long as its critical path, with enough workers.
+    """
+
+    def __init__(self):
+        self.deps, self.timings = dict(), dict()
+
+    def add(self, node, deps=()):
+        """Nodes must be hashable, dependencies must be added as nodes too"""
+        self.deps.setdefault(node, set()).update(deps)
+
+    def missing(self):
+        """returns: the dependencies that are not nodes of the graph"""
+        return set().union(*self.deps.values()).difference(self.deps) if (
+            self.deps) else set()
+
+    def cycle(self):
+        """returns: the nodes left after a topological sort, i.e., the nodes
+           in or behind a cycle (empty if the graph is acyclic)
+        """
+        deps = {node: set(d) for node, d in self.deps.items()}
+        while True:
+            free = [node for node, d in deps.items() if not d]
+            if not free:
+                return set(deps)
+            for node in free:
+                deps.pop(node)
+            for d in deps.values():
+                d.difference_update(free)
+
+    def run(self, func, workers):
+        """Call func(node, {dependency: result}) for every node
+           Nodes depending on a failed node are not run, they fail with
+           DependencyFailed
+           returns: {node: (result, error)}
+        """
+        if self.missing() or self.cycle():
+            raise ValueError('Dependencies missing or in a cycle')
+        results, running, lock = dict(), set(), Condition()
+
+        def _task(node, inputs):
+            start = time.time()
+            try:
+                result, error = func(node, inputs), None
+            except BaseException as e:
+                # e.g., SystemExit, which would kill the worker silently
+                # and leave the node running forever
+                result, error = None, e
+            with lock:
+                self.timings[node] = (start, time.time())
+                results[node] = (result, error)
+                running.discard(node)
+                lock.notify()
+
+        pool = ThreadPool(max(1, min(workers or 1, len(self.deps))))
+        try:
+            with lock:
+                while len(results) < len(self.deps):
+                    ready = [node for node, d in self.deps.items() if (
+                        node not in results and node not in running and (
+                            d.issubset(results)))]
+                    if not (ready or running):
+                        raise RuntimeError('Nodes stalled: {}'.format(
+                            ', '.join('{}'.format(node) for node in (
+                                set(self.deps).difference(results)))))
+                    if not ready:
+                        lock.wait()
+                        continue
+                    for node in ready:
+                        failed = [d for d in self.deps[node] if results[d][1]]
+                        if failed:
+                            results[node] = (
+                                None, DependencyFailed(node, failed))
+                            continue
+                        running.add(node)
+                        inputs = {d: results[d][0] for d in self.deps[node]}
+                        pool.apply_async(_task, (node, inputs))
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def critical_path(self):
+        """returns: (seconds, [nodes]) of the longest chain of dependencies,
+           measured by the timings of the last run
+        """
+        longest = dict()
+
+        def _path(node):
+            if node not in longest:
+                start, end = self.timings.get(node, (0, 0))
+                before = max(
+                    [_path(d) for d in self.deps[node]] or [(0, [])])
+                longest[node] = (before[0] + end - start, before[1] + [node])
+            return longest[node]
+        return max([_path(node) for node in self.deps] or [(0, [])])
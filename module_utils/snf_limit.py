@@ -0,0 +1,110 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import os
+import random
+import time
+from threading import Lock
+from kamaki.clients import ClientError
+from ansible.module_utils.snf_cache import CacheFile, cache_dir, cache_key
+
+DEFAULT_RETRIES, DEFAULT_BURST = 3, 10
+BACKOFF_BASE, BACKOFF_MAX = 0.5, 16
+
+# Requests rejected before being processed: always safe to retry
+RETRY_ALWAYS = (429, 503)
+# Timeouts (kamaki reports status 0) and gateway errors: the request may
+# have been processed, so retry only calls that can be repeated safely
+RETRY_IDEMPOTENT = (0, 502, 504)
+IDEMPOTENT_PREFIXES = ('get_', 'list_', 'delete_')
+
+
+class TokenBucket(object):
+    """Limit the requests per second of all module runs (e.g., ansible
+       forks) on a cloud, through a state file next to the cache
+       Each request reserves the next free slot under the file lock and
+       sleeps outside of it, so that bursts of forks are spread at "rate",
+       after the first "burst" requests.
+    """
+    _lock, waited, throttled = Lock(), 0.0, 0
+
+    def __init__(self, path, rate, burst=DEFAULT_BURST):
+        self._file = CacheFile(path)
+        self.rate, self.burst = float(rate), max(1, burst or DEFAULT_BURST)
+
+    @classmethod
+    def for_cloud(cls, cloud):
+        """returns: the bucket of a cloud, or None if "rate_limit" is not set
+        """
+        rate = cloud.get('rate_limit')
+        if not rate or rate <= 0:
+            return None
+        key = cache_key(cloud.get('url'), cloud.get('token'))
+        return cls(
+            os.path.join(cache_dir(cloud), key + '.bucket.json'),
+            rate, cloud.get('rate_burst'))
+
+    def acquire(self):
+        """Take a token, wait for it if the bucket is empty
+           returns: the seconds waited
+        """
+        now = time.time()
+
+        def _take(state):
+            elapsed = max(0, now - state.get('time', now))
+            tokens = min(
+                self.burst, state.get('tokens', self.burst) + (
+                    elapsed * self.rate)) - 1
+            state.update(tokens=tokens, time=now)
+        tokens = self._file.update(_take)['tokens']
+        wait = max(0, -tokens / self.rate)
+        if wait:
+            with self._lock:
+                TokenBucket.waited += wait
+                TokenBucket.throttled += 1
+            time.sleep(wait)
+        return wait
+
+
+def retriable(error, method):
+    """returns: True if a call to method failed with an error worth retrying
+    """
+    if error.status in RETRY_ALWAYS:
+        return True
+    return error.status in RETRY_IDEMPOTENT and method.startswith(
+        IDEMPOTENT_PREFIXES)
+
+
+def backoff(attempt):
+    """returns: seconds to sleep before retry attempt (1, 2, ...), with full
+       jitter, so that retrying forks do not hit the API in lockstep
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class Retrying(object):
+    """Wrap a kamaki client, so that its public methods are retried, with
+       jittered exponential backoff, when throttled (429), unavailable (503),
+       or, if they are safe to repeat, on timeouts and gateway errors
+    """
+    _lock, retries = Lock(), 0
+
+    def __init__(self, client, retries=DEFAULT_RETRIES):
+        self._client, self._retries = client, retries
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def retrying(*args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    return value(*args, **kwargs)
+                except ClientError as e:
+                    attempt += 1
+                    if attempt > self._retries or not retriable(e, attr):
+                        raise
+                with self._lock:
+                    Retrying.retries += 1
+                time.sleep(backoff(attempt))
+        return retrying
@@ -0,0 +1,51 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""Pithos block hashes, computed locally from memory-mapped files
+
+Pithos stores objects as lists of fixed size blocks (see the container
+"x-container-block-size"), each known by the hash of its data without the
+trailing zeros. An object is created from its hashmap, i.e., its size and
+the hashes of its blocks, and the server reports the blocks it is missing.
+"""
+import hashlib
+import mmap
+import os
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_BLOCK_HASH = 'sha256'
+
+
+def block_hash(block, algorithm=DEFAULT_BLOCK_HASH):
+    """returns: the Pithos hash (hex) of a block"""
+    return hashlib.new(algorithm, block.rstrip(b'\0')).hexdigest()
+
+
+class MappedFile(object):
+    """A file mapped in memory, read one block at a time, so that workers
+       hash and upload blocks without loading the whole file
+       e.g., with MappedFile(path, block_size) as f: f.block(0)
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE):
+        self.block_size, self._map = block_size, None
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def __enter__(self):
+        if self.size:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *args):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    @property
+    def blocks(self):
+        return (self.size + self.block_size - 1) // self.block_size
+
+    def block(self, index):
+        """returns: the data of a block"""
+        start = index * self.block_size
+        return self._map[start:start + self.block_size]
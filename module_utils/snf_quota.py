@@ -0,0 +1,67 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+"""Plan a batch of resources against the Astakos quotas of projects
+
+Astakos reports, per project, the usage and the limits of every resource,
+for the user (limit) and for the whole project (project_limit). The free
+capacity of a project is the smaller of the two. Plans are made locally
+from one quota listing, before any resource is created.
+Only the resources of VMs are planned: the floating IPs and private
+networks of a batch are created by other tasks, against their own quotas.
+"""
+
+# Astakos resource: (flavor field, units of the resource per flavor unit)
+VM_RESOURCES = {
+    'cyclades.vm': (None, 1),
+    'cyclades.total_cpu': ('vcpus', 1),
+    'cyclades.cpu': ('vcpus', 1),
+    'cyclades.total_ram': ('ram', 2 ** 20),
+    'cyclades.ram': ('ram', 2 ** 20),
+    'cyclades.disk': ('disk', 2 ** 30),
+}
+
+
+def free(quotas):
+    """returns: {project id: {resource: free units}} from Astakos quotas,
+       i.e., {project id: {resource: {usage, limit, pending, ...}}}
+    """
+    projects = dict()
+    for project_id, resources in (quotas or dict()).items():
+        projects[project_id] = {resource: min(
+            q.get('limit', 0) - q.get('usage', 0) - q.get('pending', 0),
+            q.get('project_limit', q.get('limit', 0)) - q.get(
+                'project_usage', 0) - q.get('project_pending', 0)) for (
+                    resource, q) in resources.items()}
+    return projects
+
+
+def vm_demand(flavor):
+    """returns: {resource: units} a VM of this flavor (details) takes"""
+    return {resource: int(flavor.get(field) or 0) * units if field else units
+            for resource, (field, units) in VM_RESOURCES.items()}
+
+
+def fits(available, demand):
+    """returns: True if demand fits in the available resources
+       Resources without a quota in available are not limited
+    """
+    return all(available.get(resource, units) >= units for (
+        resource, units) in demand.items())
+
+
+def allocate(demands, available, projects):
+    """Place each demand in the first of projects with room for it, in
+       order, so that a batch fills a project before spilling to the next.
+       The available resources are updated with the planned usage.
+       returns: a project id per demand, None for the ones that do not fit
+    """
+    placed = []
+    for demand in demands:
+        project_id = next((p for p in projects if p in available and (
+            fits(available[p], demand))), None)
+        if project_id:
+            room = available[project_id]
+            for resource, units in demand.items():
+                if resource in room:
+                    room[resource] -= units
+        placed.append(project_id)
+    return placed
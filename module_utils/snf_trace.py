@@ -0,0 +1,106 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import json
+import os
+import time
+from threading import Lock, local
+from kamaki.clients import ClientError
+
+# HTTP requests performed by the current thread, fed by the transport
+_http = local()
+
+
+def http_performed(request, response=None):
+    """Called by the transport for every HTTP request it performs
+       A request performed more than once was retried (e.g., on a broken
+       keep-alive connection)
+    """
+    seen = getattr(_http, 'seen', None)
+    if seen is None:
+        return
+    _http.attempts += 1
+    seen.add(id(request))
+    if response is not None:
+        _http.status = response.status
+
+
+class Tracer(object):
+    """Record every kamaki call of a module run: operation, latency, HTTP
+       status, requests and retries. Optionally, append each call as a JSON
+       line to trace_file, to aggregate the calls of a whole playbook run.
+    """
+
+    def __init__(self, module, trace_file=None):
+        self.module, self.calls, self._lock = module, [], Lock()
+        self.trace_file = trace_file and os.path.expanduser(trace_file)
+
+    def record(self, op, seconds, status=None, requests=0, retries=0,
+               error=False):
+        call = dict(
+            op=op, seconds=round(seconds, 4), status=status,
+            requests=requests, retries=retries, error=error)
+        with self._lock:
+            self.calls.append(call)
+            if self.trace_file:
+                with open(self.trace_file, 'a') as f:
+                    f.write(json.dumps(dict(
+                        call, ts=round(time.time(), 4), pid=os.getpid(),
+                        module=self.module)) + '\n')
+
+    def call(self, op, func, *args, **kwargs):
+        _http.seen, _http.attempts, _http.status = set(), 0, None
+        start, status, error = time.time(), None, False
+        try:
+            return func(*args, **kwargs)
+        except ClientError as e:
+            status, error = e.status, True
+            raise
+        finally:
+            seen, attempts = _http.seen, _http.attempts
+            _http.seen = None
+            self.record(
+                op, time.time() - start, status or _http.status,
+                len(seen), attempts - len(seen), error)
+
+    def summary(self):
+        """returns: {calls, seconds, ops: {op: {calls, errors, seconds,
+           max_seconds, requests, retries, statuses: {status: calls}}}}
+        """
+        ops = dict()
+        with self._lock:
+            calls = list(self.calls)
+        for call in calls:
+            op = ops.setdefault(call['op'], dict(
+                calls=0, errors=0, seconds=0, max_seconds=0, requests=0,
+                retries=0, statuses=dict()))
+            op['calls'] += 1
+            op['errors'] += int(call['error'])
+            op['seconds'] += call['seconds']
+            op['max_seconds'] = max(op['max_seconds'], call['seconds'])
+            op['requests'] += call['requests']
+            op['retries'] += call['retries']
+            status = '{}'.format(call['status'])
+            op['statuses'][status] = op['statuses'].get(status, 0) + 1
+        for op in ops.values():
+            op['seconds'] = round(op['seconds'], 4)
+        return dict(
+            calls=len(calls), ops=ops,
+            seconds=round(sum(c['seconds'] for c in calls), 4))
+
+
+class Traced(object):
+    """Wrap a kamaki client, so that its public methods are traced as
+       "<name>.<method>" operations
+    """
+
+    def __init__(self, client, tracer, name):
+        self._client, self._tracer, self._name = client, tracer, name
+
+    def __getattr__(self, attr):
+        value = getattr(self._client, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+        op = '{}.{}'.format(self._name, attr)
+
+        def traced(*args, **kwargs):
+            return self._tracer.call(op, value, *args, **kwargs)
+        return traced
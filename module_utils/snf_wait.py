@@ -0,0 +1,115 @@
+# Copyright 2018 Stavros Sachtouris <saxtouri@grnet.gr>
+import time
+from kamaki.clients import ClientError
+
+DEFAULT_TIMEOUT = 100
+DEFAULT_DELAY, MAX_DELAY, BACKOFF = 1, 16, 2
+
+
+def until(status):
+    """Stop waiting when status is reached. Missing resources are DELETED"""
+    return lambda r: (r or dict(status='DELETED'))['status'] == status
+
+
+def while_(status):
+    """Stop waiting when status changes. Missing resources are DELETED"""
+    return lambda r: (r or dict(status='DELETED'))['status'] != status
+
+
+class Waiter(object):
+    """Wait on many resources of the same type at once
+       Every tick polls all pending resources with one API call: a get if
+       only one resource is pending, a listing otherwise. While nothing
+       changes, the delay between ticks grows exponentially, up to max_delay
+       and never past the deadline. Errors while polling are counted and
+       retried, timeouts are reported, not raised.
+    """
+
+    def __init__(
+            self, get, list_, timeout=DEFAULT_TIMEOUT,
+            delay=DEFAULT_DELAY, max_delay=MAX_DELAY, backoff=BACKOFF):
+        """
+        :param get: (callable) id -> resource details
+        :param list_: (callable) -> detailed resources of this type
+        """
+        self.get, self.list = get, list_
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.delay, self.max_delay, self.backoff = delay, max_delay, backoff
+        self.pending, self.ready = dict(), dict()
+        self.polls, self.errors = 0, 0
+
+    def add(self, id_, stop):
+        """:param stop: (callable) record or None -> True to stop waiting"""
+        self.pending['{}'.format(id_)] = stop
+
+    def _poll(self):
+        if len(self.pending) == 1:
+            id_ = list(self.pending)[0]
+            try:
+                return {id_: self.get(id_)}
+            except ClientError as e:
+                if e.status in (404, ):
+                    return {id_: None}
+                raise
+        return {'{}'.format(r['id']): r for r in self.list()}
+
+    def wait(self):
+        """Poll until nothing is pending, or the deadline is reached
+           returns: self
+        """
+        start = time.time()
+        deadline, delay = start + self.timeout, self.delay
+        while self.pending:
+            self.polls += 1
+            try:
+                records = self._poll()
+                done = [id_ for id_, stop in self.pending.items() if stop(
+                    records.get(id_))]
+            except ClientError:
+                self.errors, done = self.errors + 1, []
+            now = time.time()
+            for id_ in done:
+                self.pending.pop(id_)
+                self.ready[id_] = (records.get(id_), now - start)
+            if not self.pending or now >= deadline:
+                break
+            delay = self.delay if done else min(
+                delay * self.backoff, self.max_delay)
+            time.sleep(max(0, min(delay, deadline - now)))
+        return self
+
+    def wait_on(self, resources, stop):
+        """Wait on resources (dicts with an "id") with the same stop condition
+           returns: the last known details of each resource
+        """
+        for resource in resources:
+            self.add(resource['id'], stop)
+        self.wait()
+        return [self.record(r['id'], r) for r in resources]
+
+    def record(self, id_, default=None):
+        """returns: the last known details of a ready resource, or default"""
+        record, _ = self.ready.get('{}'.format(id_), (None, None))
+        return record or default
+
+    def report(self):
+        return dict(
+            ready={id_: round(t, 2) for id_, (_, t) in self.ready.items()},
+            timed_out=sorted(self.pending),
+            polls=self.polls, errors=self.errors)
+
+
+def server_waiter(compute, timeout=DEFAULT_TIMEOUT):
+    return Waiter(
+        compute.get_server_details,
+        lambda: compute.list_servers(detail=True), timeout)
+
+
+def port_waiter(network, timeout=DEFAULT_TIMEOUT):
+    return Waiter(network.get_port_details, network.list_ports, timeout)
+
+
+def volume_waiter(volume, timeout=DEFAULT_TIMEOUT):
+    return Waiter(
+        volume.get_volume_details,
+        lambda: volume.list_volumes(detail=True), timeout)